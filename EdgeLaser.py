@@ -1,21 +1,35 @@
 from __future__ import print_function
 import sys
 import socket
+import select
 import math
 import struct
 import itertools
 import time
+import json
+import collections
+import os
+import zlib
+import errno
 
 from construct import *
 from construct import macros
 
-import datetime
+# numpy is optional, it speeds up drawing many lines at once
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # HOST="192.168.1.29"
 HOST="localhost"
 PORT=4242
 
-OneChar = Struct("OneChar", String("one",1))
+# time.monotonic is not available on python 2
+monotonic = getattr(time, "monotonic", time.time)
+
+# Largest UDP payload that fits in a 1500 bytes ethernet frame
+MTU=1472
 
 
 def grouper(n, iterable):
@@ -30,64 +44,122 @@ def str_to_ord(s):
     return " ".join(str(ord(c)) for c in s)
 
 class Socket(object):
-    def __init__(self, socket):
+    # Largest datagram the server can send
+    DATAGRAM_SIZE = 65535
+
+    def __init__(self, socket, size=4*65536):
         self.sock = socket
-        self.internalbuffer = ""
+        # pending bytes are internalbuffer[start:end]
+        self.internalbuffer = bytearray(size)
+        self.start = 0
+        self.end = 0
 
     def bytesAvail(self):
         self.getFromSocket()
-        return len(self.internalbuffer)
+        return self.end - self.start
+
+    def reserve(self, size):
+        # make room for size bytes after the pending data, moving the pending
+        # data to the front of the buffer (or growing it) when needed
+        buf = self.internalbuffer
+        if len(buf) - self.end >= size:
+            return
+
+        pending = self.end - self.start
+        if pending + size > len(buf):
+            self.internalbuffer = bytearray(max(2 * len(buf), pending + size))
+        self.internalbuffer[0:pending] = buf[self.start:self.end]
+        self.start = 0
+        self.end = pending
 
     def getFromSocket(self):
-        tmp=None
-        data=None
+        self.reserve(self.DATAGRAM_SIZE)
         try :
-            data, address = self.sock.recvfrom(65535, socket.MSG_DONTWAIT)
-            self.internalbuffer+=data
+            view = memoryview(self.internalbuffer)[self.end:]
+            size = self.sock.recv_into(view, self.DATAGRAM_SIZE, socket.MSG_DONTWAIT)
         except socket.error as exc:
-            if exc.errno == 35:
-                pass
-
-        # if data:
-        #     print("Got '{}' ({}) from socket, internal buffer '{}' ({})".format(data
-        #                                                                         , str_to_ord(data)
-        #                                                                         , self.internalbuffer
-        #                                                                         , str_to_ord(self.internalbuffer))
-        #     )
-
-    def read(self, byteCount):
-        buffer=''
-        size=0
-        while self.bytesAvail() < byteCount:
-            pass
+            return 0
+
+        self.end += size
+        return size
+
+    def feed(self, data):
+        # append data received by other means than recv on the socket
+        size = len(data)
+        self.reserve(size)
+        self.internalbuffer[self.end:self.end + size] = data
+        self.end += size
+
+    def buffered(self):
+        return self.end - self.start
+
+    def byteAt(self, offset):
+        # value of a buffered byte without consuming it, None if not received yet
+        if self.start + offset < self.end:
+            return self.internalbuffer[self.start + offset]
+        return None
+
+    def consume(self, byteCount):
+        self.start += byteCount
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def waitReadable(self, timeout=None):
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def waitFor(self, byteCount, timeout=None):
+        # Block until byteCount bytes are buffered, or the timeout (in seconds)
+        # expires. Returns whether the bytes are available.
+        if timeout is not None:
+            deadline = monotonic() + timeout
+
+        while self.end - self.start < byteCount:
+            self.getFromSocket()
+            if self.end - self.start >= byteCount:
+                break
 
-        buffer = self.internalbuffer[0:byteCount]
-        self.internalbuffer=self.internalbuffer[byteCount:]
-        # print("Buffer {}".format(self.internalbuffer))
-        return buffer
+            remaining = None
+            if timeout is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+            self.waitReadable(remaining)
 
-    def peek(self, byteCount):
-        buffer=''
-        size=0
-        while self.bytesAvail() < byteCount:
-            pass
+        return True
+
+    def read(self, byteCount, timeout=None):
+        if not self.waitFor(byteCount, timeout):
+            return None
 
-        buffer = self.internalbuffer[0:byteCount]
+        buffer = self.slice(byteCount)
+        self.consume(byteCount)
         return buffer
 
+    def peek(self, byteCount, timeout=None):
+        if not self.waitFor(byteCount, timeout):
+            return None
 
-class AbstractCommand(object):
-    def parse_type(self, data):
-        parsed = OneChar.parse(data)
+        return self.slice(byteCount)
+
+    def slice(self, byteCount):
+        return memoryview(self.internalbuffer)[self.start:self.start + byteCount].tobytes()
 
-        # print ("Parsed : {}".format(parsed.one))
 
-        return parsed.one
+class AbstractCommand(object):
+    opcode = None
+    # bytes following the opcode
+    length = 0
+    # only the latest of several queued commands of this type matters
+    coalesce = False
 
     def parse(self, socket, game):
         pass
 
 class PlayerKeyCommand(AbstractCommand):
+    opcode = 'I'
+    length = 2
+    coalesce = True
 
     def __init__(self):
         self.key = None
@@ -96,13 +168,7 @@ class PlayerKeyCommand(AbstractCommand):
 
 
     def parse(self, socket, game):
-        # print("Try to parse PlayerKey")
-        if not self.parse_type(socket.peek(1)) == 'I' :
-            return False
-
-        # print("Parsed PlayerKey")
-
-        socket.read(1)
+        socket.consume(1)
 
         data = socket.read(2)
 
@@ -111,7 +177,6 @@ class PlayerKeyCommand(AbstractCommand):
         self.player1 = packet.player1
         self.player2 = packet.player2
 
-        # print("Player {} key {}".format(self.player, self.key))
         # print("Player 1 {}".format(self.player1))
         # print("Player 2 {}".format(self.player2))
 
@@ -125,17 +190,14 @@ AckPacket = Struct("AckPacket",
 )
 
 class AckCommand(AbstractCommand):
-
-
+    opcode = 'A'
+    length = 1
 
     def __init__(self):
         self.id = None
 
     def parse(self, socket, game):
-        if not self.parse_type(socket.peek(1)) == 'A' :
-            return False
-
-        socket.read(1)
+        socket.consume(1)
 
         data = socket.read(1)
 
@@ -151,41 +213,75 @@ class AckCommand(AbstractCommand):
 
 
 class GoCommand(AbstractCommand):
+    opcode = 'G'
 
     def parse(self, socket, game):
-        if not self.parse_type(socket.peek(1)) == 'G' :
-            return False
-
-        # socket.read(2)
-        socket.read(1)
+        socket.consume(1)
 
         game.stopped = False
 
         return True
 
 class StopCommand(AbstractCommand):
+    opcode = 'S'
 
     def parse(self, socket, game):
-        if not self.parse_type(socket.peek(1)) == 'S' :
-            return False
-
-        # socket.read(2)
-        socket.read(1)
+        socket.consume(1)
 
         game.stopped = True
 
         return True
 
+# server commands by opcode byte
+ServerCommands = dict((ord(cls.opcode), cls) for cls in [ PlayerKeyCommand, GoCommand, StopCommand, AckCommand ])
+
+def dispatchCommands(socket, game):
+    # Parse every complete command buffered in socket and apply it to game.
+    # Returns the parsed commands, keeping only the latest of the coalesced
+    # ones.
+    commands = []
+    latest = {}
+
+    while socket.buffered():
+        opcode = socket.byteAt(0)
+        cls = ServerCommands.get(opcode)
+
+        if cls is None:
+            # skip unknown bytes so they cannot stall the stream
+            socket.consume(1)
+            continue
+
+        size = 1 + cls.length
+        if socket.buffered() < size:
+            break
+
+        if cls.coalesce:
+            if socket.byteAt(size) == opcode:
+                # a newer packet of the same type follows
+                socket.consume(size)
+                continue
+            if cls in latest:
+                commands.remove(latest[cls])
+
+        inst = cls()
+        inst.parse(socket, game)
+        commands.append(inst)
+
+        if cls.coalesce:
+            latest[cls] = inst
+
+    return commands
+
 HelloPacket = Struct("HelloPacket",
-     Const(Bytes("id", 1), '\x00'),
-     Magic('H'),
+     Const(Bytes("id", 1), b'\x00'),
+     Magic(b"H"),
      macros.CString("gamename"),
 )
 
 LinePacket = Struct("LinePacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("L"),
+    Magic(b"L"),
     ULInt16("x1"),
     ULInt16("y1"),
     ULInt16("x2"),
@@ -196,7 +292,7 @@ LinePacket = Struct("LinePacket",
 CirclePacket = Struct("CirclePacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("C"),
+    Magic(b"C"),
     ULInt16("x"),
     ULInt16("y"),
     ULInt16("diam"),
@@ -206,7 +302,7 @@ CirclePacket = Struct("CirclePacket",
 RectPacket = Struct("RectPacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("D"),
+    Magic(b"D"),
     ULInt16("x1"),
     ULInt16("y1"),
     ULInt16("x2"),
@@ -217,21 +313,40 @@ RectPacket = Struct("RectPacket",
 RefreshPacket = Struct("RefreshPacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("R"),
+    Magic(b"R"),
 )
 
 PausePacket = Struct("PausePacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("S"),
+    Magic(b"S"),
 )
 
 KinectPacket = Struct("KinectPacket",
     # Magic("C"),
     ULInt8("gameid"),
-    Magic("K"),
+    Magic(b"K"),
 )
 
+# Precompiled encoders for the draw packets, byte-identical to the construct
+# definitions above but without building a Container for every command.
+LineEncoder = struct.Struct("<BcHHHHB")
+CircleEncoder = struct.Struct("<BcHHHB")
+RectEncoder = struct.Struct("<BcHHHHB")
+RefreshEncoder = struct.Struct("<Bc")
+
+if numpy is not None:
+    # line packets as a numpy record, to encode many lines at once
+    LineRecord = numpy.dtype([
+        ("gameid", "u1"),
+        ("opcode", "S1"),
+        ("x1", "<u2"),
+        ("y1", "<u2"),
+        ("x2", "<u2"),
+        ("y2", "<u2"),
+        ("color", "u1"),
+    ])
+
 PlayerKeyPacket = Struct("PlayerKeyPacket",
     # Magic("I"),
     BitStruct("player2",
@@ -257,84 +372,912 @@ PlayerKeyPacket = Struct("PlayerKeyPacket",
 )
 
 
+class FramePacer(object):
+    # Schedules frames against absolute monotonic deadlines, so the frame rate
+    # does not drift when the sleep or the frame work is late. A frame that
+    # overruns its period is counted; with skip, the frame slots missed are
+    # dropped instead of being caught up by frames that do not sleep.
+
+    # resynchronize instead of catching up after pauses longer than this
+    MAX_LAG = 1.0
+
+    def __init__(self, fps, skip=False):
+        self.period = 1.0 / fps
+        self.skip = skip
+        self.reset()
+
+    def reset(self):
+        # deadline is the scheduled start of the current frame
+        self.deadline = None
+        self.frame_start = None
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.work_time = 0.0
+        self.sleep_time = 0.0
+        self.fps = 0.0
+        self.window_start = None
+        self.window_frames = 0
+
+    def begin(self):
+        now = monotonic()
+        if self.deadline is None or now - self.deadline > self.MAX_LAG:
+            self.deadline = now
+            self.window_start = now
+            self.window_frames = 0
+        self.frame_start = now
+
+    def end(self):
+        # returns how long to sleep until the next frame starts
+        now = monotonic()
+        if self.frame_start is None:
+            self.begin()
+
+        self.work_time = now - self.frame_start
+        self.deadline += self.period
+        delay = self.deadline - now
+
+        if delay < 0:
+            self.overruns += 1
+            if self.skip:
+                missed = int(-delay // self.period) + 1
+                self.skipped += missed
+                self.deadline += missed * self.period
+                delay = self.deadline - now
+            else:
+                delay = 0.0
+
+        self.sleep_time = delay
+        self.frames += 1
+        self.window_frames += 1
+        if now - self.window_start >= 1.0:
+            self.fps = self.window_frames / (now - self.window_start)
+            self.window_start = now
+            self.window_frames = 0
+
+        return delay
+
+    def stats(self):
+        return dict(frames=self.frames, overruns=self.overruns, skipped=self.skipped,
+                    work_time=self.work_time, sleep_time=self.sleep_time, fps=self.fps)
+
+
+class LaserMetrics(object):
+    # Opt-in counters of what a LaserGame does, see LaserGame.setMetrics().
+    # The counters of the last completed frame and second can be polled in
+    # .frame and .second. When a sink (a file object) is given, a csv or
+    # json line is written to it every second, and for every frame too
+    # with every_frame.
+    #
+    # receive_latency is an upper bound of how long received commands waited
+    # in the socket before being parsed: the time since the previous poll.
+    # blank_before and blank_after are the blanked travel of the frame, in
+    # device units, before and after a PathOptimizer reordered it.
+    # simplified and dropped count the primitives degraded by a FrameBudget,
+    # send_delayed and send_dropped the packets delayed and dropped by the
+    # SendQueue because the socket was full.
+
+    COUNTERS = ('packets', 'datagrams', 'bytes', 'send_errors', 'clipped', 'commands',
+                'blank_before', 'blank_after', 'simplified', 'dropped',
+                'send_delayed', 'send_dropped')
+
+    def __init__(self, sink=None, format='csv', every_frame=False):
+        self.sink = sink
+        self.format = format
+        self.every_frame = every_frame
+        self.header = False
+        self.frame = None
+        self.second = None
+        self.totals = None
+        self.second_start = monotonic()
+        self.reset()
+
+    def reset(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.receive_latency = 0.0
+
+    def current(self):
+        values = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        values['receive_latency'] = self.receive_latency
+        return values
+
+    def endFrame(self):
+        now = monotonic()
+        self.frame = self.current()
+        self.frame['time'] = now
+        self.reset()
+
+        if self.totals is None:
+            self.totals = dict(self.frame, frames=0)
+        else:
+            for name in self.COUNTERS:
+                self.totals[name] += self.frame[name]
+            self.totals['receive_latency'] = max(self.totals['receive_latency'], self.frame['receive_latency'])
+        self.totals['frames'] += 1
+
+        if self.every_frame:
+            self.write('frame', self.frame)
+
+        if now - self.second_start >= 1.0:
+            self.second = self.totals
+            self.second['time'] = now
+            self.totals = None
+            self.second_start = now
+            self.write('second', self.second)
+
+    def write(self, kind, values):
+        if self.sink is None:
+            return
+
+        fields = ('kind', 'time', 'frames') + self.COUNTERS + ('receive_latency', )
+        values = dict(values, kind=kind)
+        if self.format == 'json':
+            self.sink.write(json.dumps(values) + '\n')
+        else:
+            if not self.header:
+                self.sink.write(','.join(fields) + '\n')
+                self.header = True
+            self.sink.write(','.join(str(values.get(name, '')) for name in fields) + '\n')
+
+
+def blankTravel(lines):
+    # distance the laser travels blanked between consecutive
+    # (x1, y1, x2, y2, ...) lines
+    total = 0.0
+    for previous, line in zip(lines, lines[1:]):
+        total += math.hypot(line[0] - previous[2], line[1] - previous[3])
+    return total
+
+def reverseLines(lines):
+    return [(x2, y2, x1, y1, color) for x1, y1, x2, y2, color in reversed(lines)]
+
+
+class PathOptimizer(object):
+    # Reorders the lines of a frame to shorten the blanked jumps of the laser
+    # between them, see LaserGame.setPathOptimizer(). Lines sharing an
+    # endpoint are chained, and when a chain ends the nearest free endpoint
+    # starts the next one, reversing lines as needed. With two_opt, chains are
+    # then reordered and reversed while it shortens the path. Consecutive
+    # collinear lines of the same color are merged into one.
+    #
+    # Once time_budget seconds are spent, the lines not ordered yet are kept
+    # in their order and the frame is sent as is: .timed_out tells when that
+    # happened, .blank_before and .blank_after the travel of the last frame.
+
+    def __init__(self, two_opt=False, time_budget=0.002, merge=True):
+        self.two_opt = two_opt
+        self.time_budget = time_budget
+        self.merge = merge
+        self.blank_before = 0.0
+        self.blank_after = 0.0
+        self.timed_out = False
+
+    def optimize(self, lines):
+        # lines are (x1, y1, x2, y2, color) tuples in device units
+        self.timed_out = False
+        self.blank_before = self.blank_after = blankTravel(lines)
+        if len(lines) < 2:
+            return lines
+
+        deadline = monotonic() + self.time_budget
+        chains = self.chain(lines, deadline)
+        if self.two_opt and len(chains) > 2:
+            self.improve(chains, deadline)
+
+        lines = [line for chain in chains for line in chain]
+        if self.merge:
+            lines = self.mergeCollinear(lines)
+
+        self.blank_after = blankTravel(lines)
+        return lines
+
+    def chain(self, lines, deadline):
+        ends = {}
+        for i, line in enumerate(lines):
+            ends.setdefault((line[0], line[1]), []).append(i)
+            ends.setdefault((line[2], line[3]), []).append(i)
+
+        used = [False] * len(lines)
+        free = list(range(len(lines)))
+        if numpy is not None:
+            # both endpoints of line i are rows 2i and 2i+1
+            points = numpy.array([line[:4] for line in lines], dtype=float).reshape(-1, 2)
+            taken = numpy.zeros(len(points), dtype=bool)
+        chains = []
+        chain = None
+        x, y = lines[0][0], lines[0][1]
+
+        for _ in range(len(lines)):
+            index = None
+            for i in ends[(x, y)] if chain is not None else ():
+                if not used[i]:
+                    index = i
+                    break
+
+            if index is None:
+                # end of the chain, jump to the nearest free endpoint
+                if monotonic() > deadline:
+                    self.timed_out = True
+                    chains.extend([line] for i, line in enumerate(lines) if not used[i])
+                    break
+
+                if numpy is not None:
+                    distances = (points[:, 0] - x) ** 2 + (points[:, 1] - y) ** 2
+                    distances[taken] = numpy.inf
+                    index = int(distances.argmin()) // 2
+                else:
+                    best = None
+                    free = [i for i in free if not used[i]]
+                    for i in free:
+                        x1, y1, x2, y2 = lines[i][:4]
+                        distance = min((x1 - x) ** 2 + (y1 - y) ** 2, (x2 - x) ** 2 + (y2 - y) ** 2)
+                        if best is None or distance < best:
+                            best = distance
+                            index = i
+
+                chain = []
+                chains.append(chain)
+
+            x1, y1, x2, y2, color = lines[index]
+            if (x1 - x) ** 2 + (y1 - y) ** 2 > (x2 - x) ** 2 + (y2 - y) ** 2:
+                x1, y1, x2, y2 = x2, y2, x1, y1
+
+            used[index] = True
+            if numpy is not None:
+                taken[2 * index:2 * index + 2] = True
+            chain.append((x1, y1, x2, y2, color))
+            x, y = x2, y2
+
+        return chains
+
+    def improve(self, chains, deadline):
+        # 2-opt: reversing chains[i:j+1] only changes the jumps entering and
+        # leaving it
+        def jump(a, b):
+            return math.hypot(b[0] - a[0], b[1] - a[1])
+
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(chains) - 1):
+                if monotonic() > deadline:
+                    self.timed_out = True
+                    return
+
+                before = chains[i - 1][-1][2:4] if i > 0 else None
+                for j in range(i + 1, len(chains)):
+                    first = chains[i][0][0:2]
+                    last = chains[j][-1][2:4]
+                    after = chains[j + 1][0][0:2] if j + 1 < len(chains) else None
+
+                    old = new = 0.0
+                    if before is not None:
+                        old += jump(before, first)
+                        new += jump(before, last)
+                    if after is not None:
+                        old += jump(last, after)
+                        new += jump(first, after)
+
+                    if new < old - 1e-6:
+                        chains[i:j + 1] = [reverseLines(chain) for chain in reversed(chains[i:j + 1])]
+                        improved = True
+
+    def mergeCollinear(self, lines):
+        merged = [lines[0]]
+        for line in lines[1:]:
+            x1, y1, x2, y2, color = merged[-1]
+            dx1, dy1 = x2 - x1, y2 - y1
+            dx2, dy2 = line[2] - line[0], line[3] - line[1]
+            if line[0] == x2 and line[1] == y2 and line[4] == color \
+                    and dx1 * dy2 == dy1 * dx2 and dx1 * dx2 + dy1 * dy2 > 0:
+                merged[-1] = (x1, y1, line[2], line[3], color)
+            else:
+                merged.append(line)
+        return merged
+
+
+def simplifyPath(points, tolerance):
+    # Douglas-Peucker: the points of a path to keep so that none of the
+    # others is further than tolerance from the simplified path
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first]
+        dx, dy = points[last][0] - x1, points[last][1] - y1
+        norm = math.hypot(dx, dy)
+        farthest, index = tolerance, None
+
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                distance = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                distance = math.hypot(x - x1, y - y1)
+            if distance > farthest:
+                farthest, index = distance, i
+
+        if index is not None:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+class FrameBudget(object):
+    # Limits what a frame asks the projector to draw, see
+    # LaserGame.setFrameBudget(): at most max_segments lines and max_length
+    # of lit path, in resolution units (None for no limit). The server
+    # tessellates circles, a circle is counted as circle_segments lines and
+    # a rectangle as 4.
+    #
+    # A frame over budget is degraded in steps, lower priorities first:
+    # lines are simplified (Douglas-Peucker) and circles turned into
+    # polygons with as few sides as the tolerance allows, with a growing
+    # tolerance up to max_tolerance. If that is not enough, primitives are
+    # dropped, lowest priority and last drawn first. .simplified and
+    # .dropped count the primitives degraded in the last frame and
+    # .tolerance is the last tolerance used.
+
+    TOLERANCES = (0.5, 1, 2, 4, 8, 16)
+    MIN_CIRCLE_SIDES = 6
+
+    def __init__(self, max_segments=None, max_length=None, circle_segments=16, max_tolerance=8):
+        self.max_segments = max_segments
+        self.max_length = max_length
+        self.circle_segments = circle_segments
+        self.max_tolerance = max_tolerance
+        self.simplified = 0
+        self.dropped = 0
+        self.tolerance = 0
+
+    def cost(self, primitive):
+        # (segments, length) of a pending primitive, in device units
+        segments, shape = primitive[2], primitive[3]
+        if shape is None:
+            return len(segments), sum(math.hypot(x2 - x1, y2 - y1) for x1, y1, x2, y2 in segments)
+        if shape[0] == b'C':
+            return self.circle_segments, math.pi * shape[3]
+        return 4, 2.0 * (abs(shape[3] - shape[1]) + abs(shape[4] - shape[2]))
+
+    def apply(self, primitives, scale):
+        # primitives are LaserGame pending tuples, scale the device units
+        # per resolution unit. Returns the primitives to send.
+        self.simplified = self.dropped = 0
+        self.tolerance = 0
+        max_segments = self.max_segments
+        max_length = self.max_length * scale if self.max_length is not None else None
+
+        costs = [self.cost(primitive) for primitive in primitives]
+        total = [sum(c[0] for c in costs), sum(c[1] for c in costs)]
+
+        def fits():
+            return (max_segments is None or total[0] <= max_segments) and \
+                   (max_length is None or total[1] <= max_length)
+
+        def replace(i, primitive, cost):
+            total[0] += cost[0] - costs[i][0]
+            total[1] += cost[1] - costs[i][1]
+            costs[i] = cost
+            result[i] = primitive
+
+        if fits():
+            return primitives
+
+        result = list(primitives)
+        levels = sorted(set(primitive[0] for primitive in primitives))
+        simplified = set()
+
+        for tolerance in self.TOLERANCES:
+            if tolerance > self.max_tolerance:
+                break
+            self.tolerance = tolerance
+
+            for level in levels:
+                for i, primitive in enumerate(primitives):
+                    if primitive[0] != level:
+                        continue
+                    simpler = self.simplify(primitive, tolerance * scale)
+                    if simpler is not primitive:
+                        replace(i, simpler, self.cost(simpler))
+                        simplified.add(i)
+
+                if fits():
+                    self.simplified = len(simplified)
+                    return result
+
+        self.simplified = len(simplified)
+        dropped = set()
+        for i in sorted(range(len(result)), key=lambda i: (result[i][0], -i)):
+            replace(i, None, (0, 0.0))
+            dropped.add(i)
+            if fits():
+                break
+
+        self.dropped = len(dropped)
+        return [primitive for primitive in result if primitive is not None]
+
+    def simplify(self, primitive, tolerance):
+        # the primitive simplified with tolerance (device units), or the
+        # primitive itself when that does not make it cheaper
+        priority, color, segments, shape = primitive
+
+        if shape is None:
+            # simplify each connected run of lines
+            runs = []
+            for x1, y1, x2, y2 in segments:
+                if runs and runs[-1][-1] == (x1, y1):
+                    runs[-1].append((x2, y2))
+                else:
+                    runs.append([(x1, y1), (x2, y2)])
+
+            simpler = []
+            for run in runs:
+                if len(run) > 2 and run[0] == run[-1]:
+                    # closed: split at the point furthest from the start
+                    x, y = run[0]
+                    split = max(range(len(run)), key=lambda i: (run[i][0] - x) ** 2 + (run[i][1] - y) ** 2)
+                    run = simplifyPath(run[:split + 1], tolerance) + simplifyPath(run[split:], tolerance)[1:]
+                elif len(run) > 2:
+                    run = simplifyPath(run, tolerance)
+                simpler.extend(p1 + p2 for p1, p2 in zip(run, run[1:]))
+
+            if len(simpler) < len(segments):
+                return (priority, color, simpler, None)
+
+        elif shape[0] == b'C':
+            opcode, x, y, diameter = shape
+            radius = diameter / 2.0
+            if radius <= 0 or x < radius or y < radius or x + radius > 65535 or y + radius > 65535:
+                return primitive
+
+            if tolerance >= radius:
+                sides = self.MIN_CIRCLE_SIDES
+            else:
+                sides = max(self.MIN_CIRCLE_SIDES, int(math.ceil(math.pi / math.acos(1 - tolerance / radius))))
+
+            if sides < self.circle_segments:
+                points = [(int(round(x + radius * math.cos(2 * math.pi * i / sides))),
+                           int(round(y + radius * math.sin(2 * math.pi * i / sides)))) for i in range(sides)]
+                points.append(points[0])
+                return (priority, color, [p1 + p2 for p1, p2 in zip(points, points[1:])], None)
+
+        return primitive
+
+
+# sizes of the draw packets by opcode, the other packets (hello, kinect,
+# stop) are control packets
+DRAW_PACKET_SIZES = dict((ord(opcode), size) for opcode, size in (('L', 11), ('D', 11), ('C', 9), ('R', 2)))
+
+def scanPackets(data):
+    # number of packets of a datagram, and whether it holds control packets
+    data = bytearray(data)
+    offset = 0
+    count = 0
+    while offset + 2 <= len(data):
+        count += 1
+        size = DRAW_PACKET_SIZES.get(data[offset + 1])
+        if size is None:
+            return count, True
+        offset += size
+    return count, False
+
+
+class QueuedFrame(object):
+    def __init__(self, started):
+        self.datagrams = collections.deque()
+        self.packets = 0
+        # some of its datagrams were sent already
+        self.started = started
+        # its refresh was queued
+        self.complete = False
+        # it holds control packets
+        self.control = False
+
+
+class SendQueue(object):
+    # Datagrams a LaserGame could not send because the socket buffer was
+    # full (EAGAIN, ENOBUFS), sent in order once the socket is writable
+    # again, see LaserGame.setSendQueue().
+    #
+    # Queued datagrams are grouped by frame. When more than max_frames
+    # refreshed frames wait, the oldest frame none of whose datagrams were
+    # sent is dropped whole, so that the server never gets a refresh
+    # without its draws. Frames holding control packets are never dropped.
+    # .delayed and .dropped count the packets queued and dropped,
+    # .dropped_frames the frames.
+
+    RETRY_ERRORS = (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS)
+
+    def __init__(self, max_frames=2):
+        self.max_frames = max_frames
+        self.frames = collections.deque()
+        # number of datagrams waiting
+        self.datagrams = 0
+        self.delayed = 0
+        self.dropped = 0
+        self.dropped_frames = 0
+
+    def __len__(self):
+        return self.datagrams
+
+    def push(self, data):
+        # queue a datagram, returns its number of packets
+        packets, control = scanPackets(data)
+        if not self.frames or self.frames[-1].complete:
+            # when nothing waits, the start of this frame may have been sent
+            self.frames.append(QueuedFrame(started=not self.datagrams))
+
+        frame = self.frames[-1]
+        # copy, flush() reuses its buffer
+        frame.datagrams.append(data.tobytes() if isinstance(data, memoryview) else bytes(data))
+        frame.packets += packets
+        frame.control = frame.control or control
+        self.datagrams += 1
+        self.delayed += packets
+        return packets
+
+    def endFrame(self):
+        # the datagrams pushed since the last call make a frame. Returns the
+        # number of packets dropped to stay within max_frames.
+        if self.frames and not self.frames[-1].complete:
+            self.frames[-1].complete = True
+        self.frames = collections.deque(frame for frame in self.frames if frame.datagrams)
+
+        dropped = 0
+        complete = sum(1 for frame in self.frames if frame.complete)
+        while complete > self.max_frames:
+            for frame in self.frames:
+                if frame.complete and not frame.started and not frame.control:
+                    break
+            else:
+                break
+
+            self.frames.remove(frame)
+            complete -= 1
+            self.datagrams -= len(frame.datagrams)
+            dropped += frame.packets
+            self.dropped_frames += 1
+
+        self.dropped += dropped
+        return dropped
+
+    def pump(self, sock):
+        # send waiting datagrams until the socket would block. Returns the
+        # sizes sent and the errors of the datagrams dropped on the way.
+        sent = []
+        errors = []
+        while self.frames:
+            frame = self.frames[0]
+            if not frame.datagrams:
+                if not frame.complete:
+                    break
+                self.frames.popleft()
+                continue
+
+            try:
+                sent.append(sock.send(frame.datagrams[0]))
+            except Exception as e:
+                if getattr(e, 'errno', None) in self.RETRY_ERRORS:
+                    break
+                errors.append(e)
+
+            frame.datagrams.popleft()
+            frame.started = True
+            self.datagrams -= 1
+
+        return sent, errors
+
+    def clear(self):
+        self.frames.clear()
+        self.datagrams = 0
+
+
 class LaserGame(object):
     HOST = '127.0.0.1'
     PORT = 4242
 
-    def __init__(self,gamename):
+    # below this many lines, addLines() does not use numpy
+    VECTOR_MIN_LINES = 16
+
+    def __init__(self,gamename,host=None,port=None):
         self.gameid = 0
         self.gamename = gamename
         self.sock = None
         self.stopped = True
         self.resolution = 65536
-        self.multiplicator = 0.0
+        self.multiplicator = 0
         self.color = LaserColor.LIME # Because it's REALLY awesome
+        self.batching = False
+        self.mtu = MTU
+        self.framebuffer = None
+        self.framelength = 0
+        self.fps = None
+        self.pacer = None
+        self.metrics = None
+        # primitives held back until refresh(), see setPathOptimizer() and
+        # setFrameBudget()
+        self.optimizer = None
+        self.budget = None
+        self.pending = None
+        self.sendqueue = SendQueue()
+        self.last_poll = monotonic()
+        self.host = host or HOST
+        self.port = port or PORT
+        self.player1_keys = None
+        self.player2_keys = None
+
+        self.connect()
 
+    def connect(self):
         self.sock = socket.socket(type=socket.SOCK_DGRAM)
-        self.sock.connect((HOST, PORT))
+        self.sock.connect((self.host, self.port))
         self.sock.setblocking(0)
 
-        self.sendCmd(HelloPacket.build(Container(id='\x00', gamename=gamename)))
-
         self.socket = Socket(self.sock)
-        self.player1_keys = None
-        self.player2_keys = None
+        self.sendHello()
 
+    def sendHello(self):
+        gamename = self.gamename
+        if not isinstance(gamename, bytes):
+            gamename = gamename.encode('ascii')
+
+        self.sendCmd(HelloPacket.build(Container(id=b'\x00', gamename=gamename)))
 
     def sendCmd(self, data):
         # print("Sending '{}'".format(str(data)))
+        queue = self.sendqueue
+        if queue is not None and queue.datagrams:
+            # stay behind what already waits
+            self.delay(data)
+            self.flushSendQueue()
+            return None
+
         try:
-            return self.sock.send(data)
+            size = self.sock.send(data)
         except Exception as e:
+            if queue is not None and getattr(e, 'errno', None) in SendQueue.RETRY_ERRORS:
+                self.delay(data)
+                return None
+            if self.metrics is not None:
+                self.metrics.send_errors += 1
             print("Exception ignored in sendCmd: {}".format(e))
+            return None
+
+        if self.metrics is not None:
+            self.metrics.datagrams += 1
+            self.metrics.bytes += size
+        return size
+
+    def delay(self, data):
+        packets = self.sendqueue.push(data)
+        if self.metrics is not None:
+            self.metrics.send_delayed += packets
+
+    def flushSendQueue(self, timeout=0):
+        # send the datagrams waiting in the send queue, waiting up to
+        # timeout seconds for the socket to accept them. Returns whether
+        # the queue is empty.
+        queue = self.sendqueue
+        deadline = monotonic() + timeout
+
+        while queue is not None and queue.datagrams:
+            sent, errors = queue.pump(self.sock)
+            if self.metrics is not None:
+                self.metrics.datagrams += len(sent)
+                self.metrics.bytes += sum(sent)
+                self.metrics.send_errors += len(errors)
+            for e in errors:
+                print("Exception ignored in sendCmd: {}".format(e))
+
+            remaining = deadline - monotonic()
+            if not queue.datagrams or remaining <= 0:
+                break
+            select.select([], [self.sock], [], remaining)
+
+        return queue is None or not queue.datagrams
 
     def sendPacket(self, cls, **kwargs):
         # print("Sending {} {}".format(cls.name, ", ".join(["{}={}".format(k,v) for k,v in kwargs.iteritems()])))
-        self.sendCmd(cls.build(Container(**kwargs)))
+        data = cls.build(Container(**kwargs))
+        if self.metrics is not None:
+            self.metrics.packets += 1
+
+        if self.batching:
+            self.queuePacket(data)
+        else:
+            self.sendCmd(data)
+
+    def packPacket(self, encoder, *values):
+        if self.metrics is not None:
+            self.metrics.packets += 1
+
+        if not self.batching:
+            return self.sendCmd(encoder.pack(*values))
+
+        if self.framelength + encoder.size > self.mtu:
+            self.flush()
+
+        encoder.pack_into(self.framebuffer, self.framelength, *values)
+        self.framelength += encoder.size
+
+    def queuePacket(self, data):
+        # flush first if the packet would not fit in the current datagram
+        size = len(data)
+
+        if self.framelength + size > self.mtu:
+            self.flush()
+
+        self.framebuffer[self.framelength:self.framelength + size] = data
+        self.framelength += size
+
+    def queuePackets(self, data, size):
+        # data holds consecutive packets of size bytes, which are batched
+        # without splitting a packet across datagrams
+        if not self.batching:
+            for offset in range(0, len(data), size):
+                self.sendCmd(data[offset:offset + size])
+            return
+
+        view = memoryview(data)
+        offset = 0
+        while offset < len(data):
+            room = (self.mtu - self.framelength) // size * size
+            if room == 0:
+                self.flush()
+                continue
+
+            chunk = min(room, len(data) - offset)
+            self.framebuffer[self.framelength:self.framelength + chunk] = view[offset:offset + chunk]
+            self.framelength += chunk
+            offset += chunk
+
+    def flush(self):
+        if self.framelength:
+            self.sendCmd(memoryview(self.framebuffer)[:self.framelength])
+            self.framelength = 0
+
+        return self
+
+    def setFrameBatching(self, enabled=True, mtu=MTU):
+        # Draw commands are accumulated in a preallocated buffer and sent on
+        # refresh() in as few datagrams as the MTU allows. A datagram must hold
+        # at least one packet of the largest kind, a line.
+        if enabled and mtu < LineEncoder.size:
+            raise ValueError("mtu of {} bytes is smaller than a line packet ({} bytes)".format(mtu, LineEncoder.size))
+
+        self.flush()
+        self.batching = enabled
+        self.mtu = mtu
+        self.framebuffer = bytearray(mtu) if enabled else None
+
+        return self
 
     def setResolution(self, px):
+        # Coordinates go from 0 to px and are sent as 16 bits fixed point,
+        # floor(v * multiplicator + 0.5) with the integer multiplicator
+        # 65535 // px. Lines and rectangles are clipped to [0, px] before,
+        # and px * multiplicator <= 65535, so their values always fit in
+        # the 16 bits fields. Circles are not clipped, their values are
+        # saturated to [0, 65535].
         self.resolution = px
-        self.multiplicator = math.floor(65535.0/px);
+        self.multiplicator = int(65535 // px)
 
         return self
 
+    def fixed(self, value):
+        # value in device units, rounded and saturated to 16 bits
+        return min(max(int(math.floor(value * self.multiplicator + 0.5)), 0), 65535)
+
+    def fixedArray(self, values):
+        # fixed() for a numpy array, in one pass
+        return numpy.clip(numpy.floor(values * self.multiplicator + 0.5), 0, 65535).astype(numpy.uint16)
+
     def setDefaultColor(self, color):
         self.color = color
         return self
 
-    def setFrameRate(self,fps):
+    def setSendQueue(self, queue):
+        # queue is a SendQueue, or None to drop the datagrams the socket
+        # does not accept right away
+        if self.sendqueue is not None and queue is not self.sendqueue:
+            self.flushSendQueue()
+            self.sendqueue.clear()
+        self.sendqueue = queue
+        return self
+
+    def setMetrics(self, metrics):
+        # metrics is a LaserMetrics, or None to disable them
+        self.metrics = metrics
+        return self
+
+    def setPathOptimizer(self, optimizer):
+        # optimizer is a PathOptimizer, or None to send lines as they are
+        # drawn. While it is set, lines are held back and sent reordered on
+        # refresh(), after the circles and rectangles of the frame.
+        self.optimizer = optimizer
+        self.holdPrimitives()
+        return self
+
+    def setFrameBudget(self, budget):
+        # budget is a FrameBudget, or None to send frames whatever their
+        # size. While it is set, primitives are held back and degraded on
+        # refresh() when the frame goes over budget.
+        self.budget = budget
+        self.holdPrimitives()
+        return self
+
+    def holdPrimitives(self):
+        # pending is a list of (priority, color, lines, shape) tuples, with
+        # lines in device units and shape the values of a circle or a
+        # rectangle packet
+        if self.optimizer is None and self.budget is None:
+            if self.pending:
+                self.sendPending()
+            self.pending = None
+        elif self.pending is None:
+            self.pending = []
+
+    def setFrameRate(self, fps, skip=False):
         self.fps=fps
+        self.pacer = FramePacer(fps, skip)
+
+        return self
 
     def newFrame(self):
-        self.last_frame_start = datetime.datetime.now()
+        if self.pacer:
+            self.pacer.begin()
 
     def endFrame(self):
-        try:
-            time.sleep(1.0/self.fps-(datetime.datetime.now()-self.last_frame_start).total_seconds())
-        except:
-            pass
+        if self.pacer:
+            delay = self.pacer.end()
+            if self.sendqueue is not None and self.sendqueue.datagrams:
+                # use the spare time to send what waits
+                start = monotonic()
+                self.flushSendQueue(delay)
+                delay -= monotonic() - start
+            time.sleep(max(delay, 0))
 
     def isStopped(self):
         return self.stopped
 
     def useKinect(self):
         self.sendPacket(KinectPacket, gameid=self.gameid)
+        self.flush()
 
-    def receiveServerCommands(self):
+    def receiveServerCommands(self, timeout=0):
         commands = []
 
         # print("Game id = {}".format(self.gameid))
 
+        if self.sendqueue is not None and self.sendqueue.datagrams:
+            self.flushSendQueue()
 
-        if not self.socket.bytesAvail():
-            return commands
 
-        for cls in [ PlayerKeyCommand, GoCommand, StopCommand, AckCommand ]:
-            inst = cls()
+        now = monotonic()
+        # data already there may have been waiting since the previous poll
+        latency = now - self.last_poll
+        self.last_poll = now
 
-            if inst.parse(self.socket, self):
-                # print(str(inst))
-                break
+        if not self.socket.waitFor(1, 0):
+            latency = 0.0
+            if not timeout or not self.socket.waitFor(1, timeout):
+                return commands
+
+        # drain every datagram already queued on the socket
+        while self.socket.getFromSocket():
+            pass
+
+        commands = dispatchCommands(self.socket, self)
+        self.last_poll = monotonic()
+
+        if self.metrics is not None:
+            self.metrics.commands += len(commands)
+            self.metrics.receive_latency = max(self.metrics.receive_latency, latency)
 
         return commands
 
@@ -373,27 +1316,172 @@ class LaserGame(object):
         return c_x1, c_y1, c_x2, c_y2
 
 
-    def addLine(self, x1, y1, x2, y2, color = None):
+    def addLine(self, x1, y1, x2, y2, color = None, priority = 0):
         m = self.multiplicator
 
-        #make sure coordinates are in the correct range
+        #make sure coordinates are in the correct range, then the values
+        #are rounded without saturating, see setResolution()
         x1, y1, x2, y2 = self.liangbarsky(x1, y1, x2, y2)
 
-        if x1 is not None:
-            self.sendPacket(LinePacket, gameid=self.gameid, x1=x1*m, y1=y1*m, x2=x2*m, y2=y2*m, color=color or self.color)
+        if x1 is None:
+            if self.metrics is not None:
+                self.metrics.clipped += 1
+        elif self.pending is not None:
+            self.pending.append((priority, color or self.color, [(int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5))], None))
+        else:
+            self.packPacket(LineEncoder, self.gameid, b'L', int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5), color or self.color)
 
         return self
 
 
-    def addCircle(self, x, y, dim, color = None):
+    def clipLines(self, x1, y1, x2, y2):
+        # liangbarsky() for numpy arrays of segments, in one pass. Returns the
+        # clipped coordinates and a mask of the segments left visible.
+        res = self.resolution
+        dx = x2 - x1
+        dy = y2 - y1
+        dt0 = numpy.zeros(len(x1))
+        dt1 = numpy.ones(len(x1))
+        keep = numpy.ones(len(x1), dtype=bool)
+
+        checks = ((-dx, x1 - 0),   # left
+                 (dx, res - x1),   # right
+                 (-dy, y1 - 0),  # top
+                 (dy, res - y1))     # bottom
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            for p, q in checks:
+                keep &= ~((p == 0) & (q < 0))
+                dt = q / p
+                neg = p < 0
+                pos = p > 0
+                keep &= ~(neg & (dt > dt1))
+                dt0 = numpy.where(neg, numpy.maximum(dt0, dt), dt0)
+                keep &= ~(pos & (dt < dt0))
+                dt1 = numpy.where(pos, numpy.minimum(dt1, dt), dt1)
+
+        start = dt0 > 0
+        end = dt1 < 1
+        c_x1 = numpy.where(start, x1 + dt0 * dx, x1)
+        c_y1 = numpy.where(start, y1 + dt0 * dy, y1)
+        c_x2 = numpy.where(end, x1 + dt1 * dx, x2)
+        c_y2 = numpy.where(end, y1 + dt1 * dy, y2)
+
+        return c_x1, c_y1, c_x2, c_y2, keep
+
+    def addLines(self, lines, color = None, x = 0, y = 0, priority = 0):
+        # lines is a sequence of (x1, y1, x2, y2) tuples or a (N, 4) array,
+        # drawn offset by (x, y)
+        if numpy is not None and len(lines) >= self.VECTOR_MIN_LINES:
+            return self.addLinesArray(numpy.asarray(lines, dtype=float).reshape(-1, 4), color, x, y, priority)
+
         m = self.multiplicator
+        color = color or self.color
+        gameid = self.gameid
+        liangbarsky = self.liangbarsky
+        packPacket = self.packPacket
+        pending = [] if self.pending is not None else None
+
+        for x1, y1, x2, y2 in lines:
+            x1, y1, x2, y2 = liangbarsky(x1 + x, y1 + y, x2 + x, y2 + y)
+
+            if x1 is None:
+                if self.metrics is not None:
+                    self.metrics.clipped += 1
+            elif pending is not None:
+                pending.append((int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5)))
+            else:
+                packPacket(LineEncoder, gameid, b'L', int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5), color)
+
+        if pending:
+            self.pending.append((priority, color, pending, None))
+
+        return self
+
+
+    def addPolyline(self, points, color = None, closed = False, priority = 0):
+        # points is a sequence of (x, y) or a (N, 2) array, joined by lines,
+        # the last point back to the first one when closed. All the edges
+        # are clipped and encoded together, and consecutive edges share the
+        # exact same endpoint so the server gets a connected path.
+        if len(points) < 2:
+            return self
 
-        self.sendPacket(CirclePacket, gameid=self.gameid, x=x*m, y=y*m, diam=dim*m, color=color or self.color)
+        if numpy is not None and len(points) >= self.VECTOR_MIN_LINES:
+            points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+            if closed:
+                ends = numpy.roll(points, -1, axis=0)
+            else:
+                ends = points[1:]
+                points = points[:-1]
+            return self.addLinesArray(numpy.hstack((points, ends)), color, priority=priority)
+
+        if hasattr(points, 'tolist'):
+            points = points.tolist()
+        lines = [(p1[0], p1[1], p2[0], p2[1]) for p1, p2 in zip(points[:-1], points[1:])]
+        if closed:
+            lines.append((points[-1][0], points[-1][1], points[0][0], points[0][1]))
+
+        return self.addLines(lines, color, priority=priority)
+
+    def addPolygon(self, points, color = None, priority = 0):
+        return self.addPolyline(points, color, True, priority)
+
+    def addLinesArray(self, lines, color = None, x = 0, y = 0, priority = 0, counts = None):
+        # lines is a (N, 4) array, clipped and encoded in one pass. While
+        # primitives are held back, counts splits the lines into primitives
+        # of counts[i] lines each, so the budget drops them one by one.
+        x1, y1, x2, y2, keep = self.clipLines(lines[:, 0] + x, lines[:, 1] + y, lines[:, 2] + x, lines[:, 3] + y)
+        segments = self.fixedArray(numpy.column_stack((x1[keep], y1[keep], x2[keep], y2[keep])))
+
+        if self.pending is not None:
+            if self.metrics is not None:
+                self.metrics.clipped += len(keep) - len(segments)
+            color = color or self.color
+            segments = [tuple(s) for s in segments.tolist()]
+            if counts is None:
+                if segments:
+                    self.pending.append((priority, color, segments, None))
+                return self
+
+            owners = numpy.repeat(numpy.arange(len(counts)), counts)[keep]
+            start = 0
+            for end in numpy.cumsum(numpy.bincount(owners, minlength=len(counts))).tolist():
+                if end > start:
+                    self.pending.append((priority, color, segments[start:end], None))
+                start = end
+            return self
+
+        packets = numpy.empty(len(segments), dtype=LineRecord)
+        packets["gameid"] = self.gameid
+        packets["opcode"] = b'L'
+        packets["x1"] = segments[:, 0]
+        packets["y1"] = segments[:, 1]
+        packets["x2"] = segments[:, 2]
+        packets["y2"] = segments[:, 3]
+        packets["color"] = color or self.color
+
+        if self.metrics is not None:
+            self.metrics.packets += len(packets)
+            self.metrics.clipped += len(keep) - len(packets)
+
+        self.queuePackets(packets.tobytes(), LineRecord.itemsize)
+
+        return self
+
+
+    def addCircle(self, x, y, dim, color = None, priority = 0):
+        fixed = self.fixed
+
+        if self.pending is not None:
+            self.pending.append((priority, color or self.color, [], (b'C', fixed(x), fixed(y), fixed(dim))))
+        else:
+            self.packPacket(CircleEncoder, self.gameid, b'C', fixed(x), fixed(y), fixed(dim), color or self.color)
 
         return self
 
 
-    def addRectangle(self, x1, y1, x2, y2, color = None):
+    def addRectangle(self, x1, y1, x2, y2, color = None, priority = 0):
         m = self.multiplicator
 
         # if completely outside, do nothing
@@ -405,19 +1493,134 @@ class LaserGame(object):
         # clip the rectangle if needed
         (x1, y1, x2, y2) = tuple(map(lambda i: min(max(i, 0), self.resolution - 1), [x1, y1, x2, y2]))
 
-        self.sendPacket(RectPacket, gameid=self.gameid, x1=x1*m, y1=y1*m, x2=x2*m, y2=y2*m, color=color or self.color)
+        if self.pending is not None:
+            self.pending.append((priority, color or self.color, [], (b'D', int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5))))
+        else:
+            self.packPacket(RectEncoder, self.gameid, b'D', int(x1*m + 0.5), int(y1*m + 0.5), int(x2*m + 0.5), int(y2*m + 0.5), color or self.color)
+
+        return self
+
+    def record(self, draw, *args, **kwargs):
+        # Call draw(*args, **kwargs), which draws on this game, and return
+        # what it drew instead of sending it, for replay(): (data, size)
+        # with the packets of size bytes (a list of packets and None when
+        # their sizes differ), or the list of pending primitives while they
+        # are held back until refresh().
+        metrics, self.metrics = self.metrics, None
+        try:
+            if self.pending is not None:
+                pending, self.pending = self.pending, []
+                try:
+                    draw(*args, **kwargs)
+                    return self.pending
+                finally:
+                    self.pending = pending
+
+            packets = []
+            batching, self.batching = self.batching, False
+            self.sendCmd = packets.append
+            try:
+                draw(*args, **kwargs)
+            finally:
+                del self.sendCmd
+                self.batching = batching
+
+            sizes = set(len(packet) for packet in packets)
+            if len(sizes) > 1:
+                return packets, None
+            return b''.join(packets), sizes.pop() if sizes else 0
+        finally:
+            self.metrics = metrics
+
+    def replay(self, recorded):
+        # draw again what record() returned
+        if isinstance(recorded, list):
+            self.pending.extend(recorded)
+            return self
+
+        data, size = recorded
+        if size is None:
+            for packet in data:
+                if self.metrics is not None:
+                    self.metrics.packets += 1
+                if self.batching:
+                    self.queuePacket(packet)
+                else:
+                    self.sendCmd(packet)
+        elif data:
+            if self.metrics is not None:
+                self.metrics.packets += len(data) // size
+            self.queuePackets(data, size)
+
+        return self
+
+    def sendPending(self):
+        # send the primitives held back during the frame, within the budget
+        # and with the lines reordered by the optimizer
+        primitives = self.pending
+        self.pending = []
+
+        if self.budget is not None:
+            primitives = self.budget.apply(primitives, self.multiplicator)
+            if self.metrics is not None:
+                self.metrics.simplified += self.budget.simplified
+                self.metrics.dropped += self.budget.dropped
+
+        lines = []
+        for priority, color, segments, shape in primitives:
+            if shape is None:
+                lines.extend((x1, y1, x2, y2, color) for x1, y1, x2, y2 in segments)
+            elif shape[0] == b'C':
+                self.packPacket(CircleEncoder, self.gameid, *(shape + (color, )))
+            else:
+                self.packPacket(RectEncoder, self.gameid, *(shape + (color, )))
+
+        if self.optimizer is not None:
+            lines = self.optimizer.optimize(lines)
+            if self.metrics is not None:
+                self.metrics.blank_before += self.optimizer.blank_before
+                self.metrics.blank_after += self.optimizer.blank_after
+
+        if numpy is not None and len(lines) >= self.VECTOR_MIN_LINES:
+            values = numpy.array(lines, dtype=int)
+            packets = numpy.empty(len(values), dtype=LineRecord)
+            packets["gameid"] = self.gameid
+            packets["opcode"] = b'L'
+            for i, name in enumerate(("x1", "y1", "x2", "y2", "color")):
+                packets[name] = values[:, i]
+
+            if self.metrics is not None:
+                self.metrics.packets += len(packets)
+            self.queuePackets(packets.tobytes(), LineRecord.itemsize)
+        else:
+            for x1, y1, x2, y2, color in lines:
+                self.packPacket(LineEncoder, self.gameid, b'L', x1, y1, x2, y2, color)
 
         return self
 
     def refresh(self):
+        if self.pending:
+            self.sendPending()
+
+        self.packPacket(RefreshEncoder, self.gameid, b'R')
+        self.flush()
+
+        queue = self.sendqueue
+        if queue is not None and queue.frames:
+            dropped = queue.endFrame()
+            if self.metrics is not None:
+                self.metrics.send_dropped += dropped
+            self.flushSendQueue()
 
-        self.sendPacket(RefreshPacket, gameid=self.gameid)
+        if self.metrics is not None:
+            self.metrics.endFrame()
 
         return self
 
     def pause(self):
 
         self.sendPacket(PausePacket, gameid=self.gameid)
+        self.flush()
         self.stopped = True
 
         return self
@@ -435,53 +1638,275 @@ class LaserColor(object):
     WHITE = 0x7
 
 
+class LRUCache(object):
+    # mapping keeping the size most recently used items, counting its hits
+    # and misses
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        if len(self.items) >= self.size:
+            self.items.popitem(last=False)
+        self.items[key] = value
+
+    def __len__(self):
+        return len(self.items)
+
+
 class LaserFont(object):
+    # number of coeff values whose scaled glyphs are kept
+    SCALED_CACHE_SIZE = 16
+    # number of texts kept laid out for render()
+    TEXT_CACHE_SIZE = 64
+
+    # fonts parsed by load(), by file
+    loaded = {}
+
     def __init__(self, file):
         self.letters = {}
         self.name = file.split('.')[0]
-        zipdata = open(file, 'rb').read()
-        zipdata = zipdata.decode('zlib').strip()
-        header = True
-
-        for data in zipdata.split('\0'):
-            if header:
-                self.spacing = struct.unpack('B', data[0])[0]
-                header = False
-            else:
-                if len(data) == 0:
-                    continue
-                char = chr(struct.unpack('B', data[0])[0])
-                coordlist = []
-                for val in data[1:]:
-                    coordlist.append(struct.unpack('B', val)[0])
-                self.letters[char] = coordlist
-
-    def render(self, game, text, x, y, color=LaserColor.LIME, coeff=1, spacing_factor=8):
-        offset_x = x
-        offset_y = y
+        data = open(file, 'rb').read()
 
+        if file.endswith('.elf'):
+            self.parseText(data)
+        else:
+            self.parseCompressed(data)
+
+        # glyph lines scaled by coeff, see scaledGlyphs()
+        self.scaled = LRUCache(self.SCALED_CACHE_SIZE)
+        self.texts = LRUCache(self.TEXT_CACHE_SIZE)
+
+    @classmethod
+    def load(cls, file):
+        # font shared by every caller in the process, parsed again only if the
+        # file changes
+        stat = os.stat(file)
+        key = (os.path.realpath(file), stat.st_mtime, stat.st_size)
+        font = cls.loaded.get(key)
+        if font is None:
+            font = cls.loaded[key] = cls(file)
+        return font
+
+    def parseCompressed(self, data):
+        # .elfc: zlib compressed, NUL separated records of bytes, the first
+        # one holds the spacing and the others a char then its coordinates
+        records = zlib.decompress(data).strip().split(b'\0')
+        self.spacing = bytearray(records[0])[0]
+
+        for record in records[1:]:
+            if len(record) == 0:
+                continue
+            values = bytearray(record)
+            self.letters[chr(values[0])] = list(values[1:])
+
+    def parseText(self, data):
+        # .elf: a key=value;... header line, then one line per char with the
+        # char and its coordinates separated by ';'
+        lines = data.splitlines()
+        header = dict(item.split(b'=', 1) for item in lines[0].split(b';') if b'=' in item)
+        self.spacing = int(header[b'spacing'])
+
+        for line in lines[1:]:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            self.letters[line[0:1].decode('ascii')] = [int(val) for val in line[2:].split(b';')]
+
+    def scaledGlyphs(self, coeff):
+        # char -> (lines, width) with the glyph lines as (x1, y1, x2, y2)
+        # tuples and the glyph width, scaled by coeff
+        glyphs = self.scaled.get(coeff)
+        if glyphs is None:
+            glyphs = {}
+            for char, coords in self.letters.items():
+                lines = tuple(tuple(val * coeff for val in line) for line in grouper(4, coords))
+                width = max([0] + [max(line[0], line[2]) for line in lines])
+                glyphs[char] = (lines, width)
+            self.scaled.put(coeff, glyphs)
+        return glyphs
+
+    def compile(self, text, coeff=1, spacing_factor=8):
+        # lay text out once, see LaserText
         if coeff < 1:
             coeff = 1
 
-        if coeff == 1:
-            scaledletters = self.letters
-        else:
-            scaledletters = {}
-            for char in self.letters.keys():
-                scaledvals = []
-                for val in self.letters[char]:
-                    scaledvals.append(val * coeff)
-                scaledletters[char] = scaledvals
+        glyphs = self.scaledGlyphs(coeff)
+        spacing = self.spacing * coeff
+        offset_x = 0
+        lines = []
 
         for char in text:
-            tmp_offset = 0
             if char == ' ':
-                tmp_offset = spacing_factor * coeff
+                offset_x += spacing_factor * coeff + spacing
             else:
-                for line in grouper(4, scaledletters[char]):
-                    game.addLine(line[0] + offset_x, line[1] + offset_y, line[2] + offset_x, line[3] + offset_y, color)
-                    tmp_offset = max(tmp_offset, max(line[0], line[2]))
-            offset_x += tmp_offset + self.spacing * coeff
+                glyph_lines, width = glyphs[char]
+                for x1, y1, x2, y2 in glyph_lines:
+                    lines.append((x1 + offset_x, y1, x2 + offset_x, y2))
+                offset_x += width + spacing
+
+        return LaserText(lines, offset_x)
+
+    def render(self, game, text, x, y, color=LaserColor.LIME, coeff=1, spacing_factor=8, priority=0):
+        key = (text, coeff, spacing_factor)
+        compiled = self.texts.get(key)
+        if compiled is None:
+            compiled = self.compile(text, coeff, spacing_factor)
+            self.texts.put(key, compiled)
+
+        compiled.draw(game, x, y, color, priority)
+
+
+class LaserText(object):
+    # Text laid out by LaserFont.compile(): its lines relative to the text
+    # origin, its bounding box and its advance width. Drawing it at any
+    # position is a single addLines() call.
+    def __init__(self, lines, width):
+        self.lines = tuple(lines)
+        self.width = width
+
+        if self.lines:
+            xs = [x for line in self.lines for x in (line[0], line[2])]
+            ys = [y for line in self.lines for y in (line[1], line[3])]
+            self.bbox = (min(xs), min(ys), max(xs), max(ys))
+        else:
+            self.bbox = None
+
+        if numpy is not None:
+            # ready for the vectorized addLines()
+            self.lines = numpy.array(self.lines, dtype=float).reshape(-1, 4)
+
+    def draw(self, game, x, y, color=LaserColor.LIME, priority=0):
+        game.addLines(self.lines, color, x, y, priority)
+        return game
+
+
+class LaserScene(object):
+    # Retained drawing on a LaserGame: primitives are added once and get a
+    # handle, then updated or removed, and draw() draws all of them for the
+    # frame. Each primitive keeps what it drew last time (see
+    # LaserGame.record()), and is only drawn again from its parameters
+    # when update() changed them or when the game resolution, default
+    # color, id or pipeline changed. .encoded and .reused count the
+    # primitives of the last draw().
+    #
+    #   scene = LaserScene(game)
+    #   border = scene.addRectangle(0, 0, 999, 999)
+    #   score = scene.addText(font, 'SCORE 0', 10, 10, coeff=3)
+    #   ...
+    #   scene.update(score, text='SCORE 100')
+    #   scene.draw()
+    #   game.refresh()
+
+    def __init__(self, game):
+        self.game = game
+        # handle -> [draw, params, key, recorded], in drawing order
+        self.primitives = collections.OrderedDict()
+        self.next_handle = 1
+        self.state = None
+        self.encoded = 0
+        self.reused = 0
+
+    def freeze(self, value):
+        # a hashable copy of a parameter, so that later changes to the
+        # caller's list or array are not missed
+        if numpy is not None and isinstance(value, numpy.ndarray):
+            value = value.copy()
+            value.flags.writeable = False
+            return value, (value.shape, value.dtype.str, value.tobytes())
+        if isinstance(value, (list, tuple)):
+            frozen = tuple(self.freeze(item) for item in value)
+            return tuple(item for item, key in frozen), tuple(key for item, key in frozen)
+        return value, value
+
+    def add(self, draw, **params):
+        # draw(**params) draws the primitive on the game
+        handle = self.next_handle
+        self.next_handle += 1
+        self.primitives[handle] = [draw, {}, {}, None]
+        self.update(handle, **params)
+        return handle
+
+    def addLine(self, x1, y1, x2, y2, color=None, priority=0):
+        return self.add(self.game.addLine, x1=x1, y1=y1, x2=x2, y2=y2, color=color, priority=priority)
+
+    def addLines(self, lines, color=None, x=0, y=0, priority=0):
+        return self.add(self.game.addLines, lines=lines, color=color, x=x, y=y, priority=priority)
+
+    def addPolyline(self, points, color=None, closed=False, priority=0):
+        return self.add(self.game.addPolyline, points=points, color=color, closed=closed, priority=priority)
+
+    def addPolygon(self, points, color=None, priority=0):
+        return self.add(self.game.addPolygon, points=points, color=color, priority=priority)
+
+    def addCircle(self, x, y, dim, color=None, priority=0):
+        return self.add(self.game.addCircle, x=x, y=y, dim=dim, color=color, priority=priority)
+
+    def addRectangle(self, x1, y1, x2, y2, color=None, priority=0):
+        return self.add(self.game.addRectangle, x1=x1, y1=y1, x2=x2, y2=y2, color=color, priority=priority)
+
+    def addText(self, font, text, x, y, color=LaserColor.LIME, coeff=1, spacing_factor=8, priority=0):
+        return self.add(font.render, game=self.game, text=text, x=x, y=y, color=color,
+                        coeff=coeff, spacing_factor=spacing_factor, priority=priority)
+
+    def update(self, handle, **params):
+        # change some parameters of a primitive, by name
+        primitive = self.primitives[handle]
+        draw, current, keys, recorded = primitive
+
+        for name, value in params.items():
+            value, key = self.freeze(value)
+            if name not in keys or keys[name] != key:
+                current[name] = value
+                keys[name] = key
+                primitive[3] = None
+
+        return handle
+
+    def remove(self, handle):
+        del self.primitives[handle]
+
+    def clear(self):
+        self.primitives.clear()
+
+    def __len__(self):
+        return len(self.primitives)
+
+    def __contains__(self, handle):
+        return handle in self.primitives
+
+    def draw(self):
+        game = self.game
+        state = (game.pending is not None, game.gameid, game.resolution, game.multiplicator, game.color)
+        if state != self.state:
+            self.state = state
+            for primitive in self.primitives.values():
+                primitive[3] = None
+
+        self.encoded = self.reused = 0
+        for primitive in self.primitives.values():
+            if primitive[3] is None:
+                primitive[3] = game.record(primitive[0], **primitive[1])
+                self.encoded += 1
+            else:
+                self.reused += 1
+            game.replay(primitive[3])
+
+        return game
 
 
 if __name__ == '__main__':
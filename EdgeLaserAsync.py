@@ -0,0 +1,98 @@
+import asyncio
+
+import EdgeLaser
+
+
+class LaserProtocol(asyncio.DatagramProtocol):
+    def __init__(self, game):
+        self.game = game
+
+    def connection_made(self, transport):
+        self.game.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.game.dataReceived(data)
+
+    def error_received(self, exc):
+        print("Exception ignored in LaserProtocol: {}".format(exc))
+
+    def connection_lost(self, exc):
+        self.game.transport = None
+
+
+class AsyncLaserGame(EdgeLaser.LaserGame):
+    # LaserGame driven by an asyncio event loop: server commands are handled
+    # as soon as their datagram arrives and frames are scheduled on the loop,
+    # so several games can share one process without busy waiting.
+    #
+    #   game = AsyncLaserGame('EdgeSteroid')
+    #   await game.start()
+    #   await game.run(draw_frame)
+
+    def __init__(self, gamename, host=None, port=None):
+        self.transport = None
+        self.running = None
+        EdgeLaser.LaserGame.__init__(self, gamename, host, port)
+        self.setFrameRate(30)
+
+    def connect(self):
+        # the datagram endpoint needs a running loop, see start()
+        self.socket = EdgeLaser.Socket(None)
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.running = asyncio.Event()
+        await loop.create_datagram_endpoint(lambda: LaserProtocol(self), remote_addr=(self.host, self.port))
+        self.sendHello()
+        return self
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    def sendCmd(self, data):
+        if self.transport is None:
+            if self.metrics is not None:
+                self.metrics.send_errors += 1
+            print("Exception ignored in sendCmd: not connected")
+            return None
+
+        self.transport.sendto(data)
+        if self.metrics is not None:
+            self.metrics.datagrams += 1
+            self.metrics.bytes += len(data)
+        return len(data)
+
+    def dataReceived(self, data):
+        self.socket.feed(data)
+        commands = EdgeLaser.dispatchCommands(self.socket, self)
+        if self.metrics is not None:
+            self.metrics.commands += len(commands)
+
+        if self.stopped:
+            self.running.clear()
+        else:
+            self.running.set()
+
+        return commands
+
+    def receiveServerCommands(self, timeout=0):
+        # commands are dispatched by the protocol as they arrive
+        return []
+
+    async def waitRunning(self):
+        await self.running.wait()
+
+    async def run(self, frame):
+        # Call frame(game) to draw each frame while the server lets the game
+        # run, refreshing after each call. Returns when the server stops the
+        # game.
+        await self.waitRunning()
+        self.pacer.reset()
+
+        while not self.stopped:
+            self.pacer.begin()
+            frame(self)
+            self.refresh()
+
+            await asyncio.sleep(self.pacer.end())
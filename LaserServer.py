@@ -0,0 +1,260 @@
+from __future__ import print_function
+import socket
+import select
+import struct
+import sys
+import threading
+import time
+
+import EdgeLaser
+
+LineStruct = struct.Struct("<HHHHB")
+CircleStruct = struct.Struct("<HHHB")
+
+KEYS = ('xp', 'xn', 'yp', 'yn', 'x', 'y', 'a', 'b')
+
+
+def keys(**pressed):
+    # key state byte of a player, e.g. keys(xp=True, a=True)
+    value = 0
+    for bit, name in enumerate(KEYS):
+        if pressed.get(name):
+            value |= 0x80 >> bit
+    return value
+
+
+class ServerGame(object):
+    def __init__(self, gameid, name, address):
+        self.gameid = gameid
+        self.name = name
+        self.address = address
+        self.frames = 0
+        self.last_refresh = None
+        self.reset()
+
+    def reset(self):
+        self.primitives = []
+        self.packets = 0
+        self.datagrams = 0
+        self.bytes = 0
+
+
+class Frame(object):
+    # one frame received from a game, closed by its refresh packet
+    def __init__(self, game, index, start, end):
+        self.gameid = game.gameid
+        self.index = index
+        self.primitives = game.primitives
+        self.packets = game.packets
+        self.datagrams = game.datagrams
+        self.bytes = game.bytes
+        self.interval = end - start if start is not None else None
+        self.time = end
+
+    def lines(self):
+        return [p[1:] for p in self.primitives if p[0] == 'L']
+
+    def stats(self):
+        lines = self.lines()
+        length = 0.0
+        blank = 0.0
+        last = None
+        for x1, y1, x2, y2, color in lines:
+            length += ((x2 - x1) ** 2 + (y2 - y1) ** 2) ** 0.5
+            if last is not None:
+                blank += ((x1 - last[0]) ** 2 + (y1 - last[1]) ** 2) ** 0.5
+            last = (x2, y2)
+
+        return dict(gameid=self.gameid, index=self.index, interval=self.interval,
+                    packets=self.packets, datagrams=self.datagrams, bytes=self.bytes,
+                    lines=len(lines),
+                    circles=sum(1 for p in self.primitives if p[0] == 'C'),
+                    rectangles=sum(1 for p in self.primitives if p[0] == 'D'),
+                    length=length, blank=blank)
+
+
+class LaserServer(object):
+    # Stand-in for the EdgeLaser server speaking its UDP protocol: it answers
+    # the Hello of a game with its id ('A') and lets it run ('G'), records
+    # the draw packets it receives frame by frame, and can send scripted
+    # key input ('I') to the games.
+    #
+    #   server = LaserServer(port=0).start()
+    #   game = EdgeLaser.LaserGame('test', *server.address)
+    #   ...
+    #   server.waitFrames(10)
+    #   print(server.frames[-1].stats())
+
+    def __init__(self, host='127.0.0.1', port=EdgeLaser.PORT, autostart=True, keep=None):
+        self.sock = socket.socket(type=socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.address = self.sock.getsockname()
+        self.autostart = autostart
+        # number of frames kept in .frames, None keeps them all
+        self.keep = keep
+        self.games = {}
+        self.frames = []
+        self.frame_count = 0
+        # key input to send when a frame index is reached, see script()
+        self.scripted = {}
+        self.thread = None
+        self.running = False
+        self.condition = threading.Condition()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.sock.close()
+
+    def serve(self):
+        while self.running:
+            readable, _, _ = select.select([self.sock], [], [], 0.1)
+            if readable:
+                data, address = self.sock.recvfrom(65535)
+                self.handle(bytearray(data), address)
+
+    def handle(self, data, address):
+        if data[0:2] == b'\x00H':
+            self.hello(data[2:].split(b'\x00')[0].decode('ascii'), address)
+            return
+
+        game = self.games.get(address)
+        if game is None:
+            print("Ignoring datagram from unknown game at {}".format(address))
+            return
+
+        game.datagrams += 1
+        game.bytes += len(data)
+        offset = 0
+
+        while offset + 2 <= len(data):
+            opcode = chr(data[offset + 1])
+            offset += 2
+            game.packets += 1
+
+            if opcode == 'L' or opcode == 'D':
+                game.primitives.append((opcode, ) + LineStruct.unpack_from(data, offset))
+                offset += LineStruct.size
+            elif opcode == 'C':
+                game.primitives.append((opcode, ) + CircleStruct.unpack_from(data, offset))
+                offset += CircleStruct.size
+            elif opcode == 'R':
+                self.refresh(game)
+            elif opcode == 'S' or opcode == 'K':
+                game.primitives.append((opcode, ))
+            else:
+                print("Unknown opcode {!r} from game {}".format(opcode, game.gameid))
+                return
+
+    def hello(self, name, address):
+        game = self.games.get(address)
+        if game is None:
+            game = ServerGame(len(self.games) + 1, name, address)
+            self.games[address] = game
+
+        self.sock.sendto(b'A' + struct.pack('B', game.gameid), address)
+        if self.autostart:
+            self.go(game.gameid)
+
+    def refresh(self, game):
+        frame = Frame(game, game.frames, game.last_refresh, EdgeLaser.monotonic())
+        game.frames += 1
+        game.last_refresh = frame.time
+        game.reset()
+
+        with self.condition:
+            self.frames.append(frame)
+            if self.keep is not None and len(self.frames) > self.keep:
+                del self.frames[0]
+            self.frame_count += 1
+            self.condition.notify_all()
+
+        for player1, player2 in self.scripted.pop((game.gameid, frame.index), []):
+            self.sendKeys(player1, player2, game.gameid)
+
+    def waitFrames(self, count, timeout=None):
+        # wait until count frames in total have been received
+        if timeout is not None:
+            deadline = EdgeLaser.monotonic() + timeout
+
+        with self.condition:
+            while self.frame_count < count:
+                remaining = None
+                if timeout is not None:
+                    remaining = deadline - EdgeLaser.monotonic()
+                    if remaining <= 0:
+                        break
+                self.condition.wait(remaining)
+            return self.frame_count >= count
+
+    def addresses(self, gameid=None):
+        return [game.address for game in self.games.values() if gameid is None or game.gameid == gameid]
+
+    def send(self, data, gameid=None):
+        for address in self.addresses(gameid):
+            self.sock.sendto(data, address)
+
+    def go(self, gameid=None):
+        self.send(b'G', gameid)
+
+    def pause(self, gameid=None):
+        self.send(b'S', gameid)
+
+    def sendKeys(self, player1=0, player2=0, gameid=None):
+        self.send(b'I' + struct.pack('BB', player2, player1), gameid)
+
+    def script(self, frame, player1=0, player2=0, gameid=1):
+        # send the key states once the game has refreshed the given frame
+        self.scripted.setdefault((gameid, frame), []).append((player1, player2))
+        return self
+
+
+def report(frames):
+    by_game = {}
+    for frame in frames:
+        by_game.setdefault(frame.gameid, []).append(frame.stats())
+
+    for gameid, stats in sorted(by_game.items()):
+        count = float(len(stats))
+        intervals = [s['interval'] for s in stats if s['interval']]
+        fps = len(intervals) / sum(intervals) if intervals else 0.0
+        print("[LaserServer] game {}: {:.1f} fps, {:.0f} lines, {:.0f} circles, {:.0f} rectangles, {:.0f} bytes, {:.0f} blank travel per frame".format(
+            gameid, fps,
+            sum(s['lines'] for s in stats) / count,
+            sum(s['circles'] for s in stats) / count,
+            sum(s['rectangles'] for s in stats) / count,
+            sum(s['bytes'] for s in stats) / count,
+            sum(s['blank'] for s in stats) / count))
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else EdgeLaser.PORT
+    server = LaserServer(host='0.0.0.0', port=port, keep=1000)
+    print("[LaserServer] listening on {}:{}".format(*server.address))
+    server.start()
+
+    last = EdgeLaser.monotonic()
+    try:
+        while True:
+            time.sleep(1.0)
+            now = EdgeLaser.monotonic()
+            with server.condition:
+                frames = [frame for frame in server.frames if frame.time > last]
+            last = now
+            report(frames)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,312 @@
+from __future__ import print_function
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import struct
+import sys
+import timeit
+
+import EdgeLaser
+
+KEY_PACKET = b'I' + struct.pack('BB', 0x0f, 0xf0)
+
+FONT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lcd.elfc')
+
+RESOLUTION = 1000
+
+
+class KeyState(object):
+    def __init__(self):
+        self.player1_keys = None
+        self.player2_keys = None
+
+
+class Result(object):
+    def __init__(self, name, ops, latencies):
+        self.name = name
+        self.ops = ops
+        self.latencies = sorted(latencies)
+        self.total = sum(latencies)
+
+    def percentile(self, p):
+        index = min(len(self.latencies) - 1, int(math.ceil(p / 100.0 * len(self.latencies))) - 1)
+        return self.latencies[max(index, 0)]
+
+    def ops_per_sec(self):
+        return self.ops / self.total
+
+    def to_dict(self):
+        return dict(ops_per_sec=self.ops_per_sec(), p50=self.percentile(50),
+                    p90=self.percentile(90), p99=self.percentile(99))
+
+    def __str__(self):
+        return "{:<44} {:>10.0f} ops/s   p50 {:7.3f} ms   p90 {:7.3f} ms   p99 {:7.3f} ms".format(
+            self.name, self.ops_per_sec(), self.percentile(50) * 1000,
+            self.percentile(90) * 1000, self.percentile(99) * 1000)
+
+
+def measure(name, frame, ops, frames):
+    # call frame() frames times, ops is the number of operations per call
+    latencies = []
+    timer = timeit.default_timer
+    for _ in range(frames):
+        start = timer()
+        frame()
+        latencies.append(timer() - start)
+    return Result(name, ops * frames, latencies)
+
+
+def udp_pair():
+    rx = socket.socket(type=socket.SOCK_DGRAM)
+    rx.bind(('127.0.0.1', 0))
+    rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    tx = socket.socket(type=socket.SOCK_DGRAM)
+    tx.connect(rx.getsockname())
+    return rx, tx
+
+
+def loopback_game(sink, batching, optimize=False):
+    # a running game sending to a socket nobody reads, the kernel drops what
+    # does not fit in its buffer
+    game = EdgeLaser.LaserGame('bench', *sink.getsockname())
+    game.setResolution(RESOLUTION).setFrameBatching(batching)
+    if optimize:
+        game.setPathOptimizer(EdgeLaser.PathOptimizer())
+    game.stopped = False
+    return game
+
+
+def bench_receive_keys(count=5000, per_datagram=400, repeat=3):
+    # queue count key packets on a loopback socket, each followed by a go
+    # so that dispatchCommands() parses every one of them instead of
+    # skipping to the latest, then time how long the client needs to
+    # parse all of them
+    rx, tx = udp_pair()
+    sock = EdgeLaser.Socket(rx)
+    state = KeyState()
+    packets = KEY_PACKET + b'G'
+    latencies = []
+    timer = timeit.default_timer
+
+    for _ in range(repeat):
+        sent = 0
+        while sent < count:
+            n = min(per_datagram, count - sent)
+            tx.send(packets * n)
+            sent += n
+
+        start = timer()
+        remaining = count * len(packets)
+        while remaining:
+            sock.waitFor(1)
+            buffered = sock.buffered()
+            EdgeLaser.dispatchCommands(sock, state)
+            remaining -= buffered - sock.buffered()
+        latencies.append(timer() - start)
+
+    rx.close()
+    tx.close()
+    return Result("parse keys (burst)", 2 * count * repeat, latencies)
+
+
+def bench_receive_commands(game, sink, per_frame=20, frames=200):
+    # per_frame key datagrams and a go queued before each poll
+    game.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    address = game.sock.getsockname()
+    latencies = []
+    timer = timeit.default_timer
+
+    for i in range(frames):
+        for _ in range(per_frame):
+            sink.sendto(KEY_PACKET, address)
+        sink.sendto(b'G', address)
+        game.socket.waitFor(1, 1.0)
+
+        start = timer()
+        game.receiveServerCommands()
+        latencies.append(timer() - start)
+
+    return Result("receiveServerCommands", (per_frame + 1) * frames, latencies)
+
+
+def bench_draw(game, frames):
+    rnd = random.Random(42)
+    inside = [(rnd.uniform(0, RESOLUTION), rnd.uniform(0, RESOLUTION),
+               rnd.uniform(0, RESOLUTION), rnd.uniform(0, RESOLUTION)) for _ in range(200)]
+    outside = [(rnd.uniform(-RESOLUTION, 2 * RESOLUTION), rnd.uniform(-RESOLUTION, 2 * RESOLUTION),
+                rnd.uniform(-RESOLUTION, 2 * RESOLUTION), rnd.uniform(-RESOLUTION, 2 * RESOLUTION)) for _ in range(200)]
+
+    def lines(segments):
+        def frame():
+            for x1, y1, x2, y2 in segments:
+                game.addLine(x1, y1, x2, y2)
+            game.refresh()
+        return frame
+
+    def bulk(segments):
+        def frame():
+            game.addLines(segments)
+            game.refresh()
+        return frame
+
+    polygons = [[(x + rnd.uniform(-30, 30), y + rnd.uniform(-30, 30)) for _ in range(4)]
+                for x, y, _, _ in inside[:50]]
+
+    def polygon():
+        for points in polygons:
+            game.addPolygon(points)
+        game.refresh()
+
+    def rectangles():
+        for x1, y1, x2, y2 in outside:
+            game.addRectangle(x1, y1, x2, y2)
+        game.refresh()
+
+    def circles():
+        for x, y, d, _ in inside:
+            game.addCircle(x, y, d / 10)
+        game.refresh()
+
+    return [
+        measure("addLine (unclipped)", lines(inside), len(inside), frames),
+        measure("addLine (clipped)", lines(outside), len(outside), frames),
+        measure("addLines (unclipped)", bulk(inside), len(inside), frames),
+        measure("addLines (clipped)", bulk(outside), len(outside), frames),
+        measure("addPolygon (4 points)", polygon, len(polygons), frames),
+        measure("addRectangle", rectangles, len(outside), frames),
+        measure("addCircle", circles, len(inside), frames),
+    ]
+
+
+def bench_font(game, frames):
+    font = EdgeLaser.LaserFont.load(FONT)
+    results = []
+
+    for coeff in (1, 5, 20):
+        def frame():
+            font.render(game, 'EDGEFEST 2014', 10, 10, coeff=coeff)
+            game.refresh()
+        results.append(measure("LaserFont.render coeff={}".format(coeff), frame, 1, frames))
+
+    return results
+
+
+def bench_scene(game, frames):
+    # a static scene redrawn every frame, with one text changing
+    rnd = random.Random(42)
+    font = EdgeLaser.LaserFont.load(FONT)
+    scene = EdgeLaser.LaserScene(game)
+    scene.addRectangle(0, 0, RESOLUTION - 1, RESOLUTION - 1)
+    for _ in range(50):
+        x, y = rnd.uniform(0, RESOLUTION), rnd.uniform(0, RESOLUTION)
+        scene.addPolygon([(x + rnd.uniform(-30, 30), y + rnd.uniform(-30, 30)) for _ in range(4)])
+    score = scene.addText(font, 'SCORE 0', 10, 10, coeff=5)
+    counter = [0]
+
+    def frame():
+        counter[0] += 1
+        scene.update(score, text='SCORE {}'.format(counter[0] // 30))
+        scene.draw()
+        game.refresh()
+
+    return measure("LaserScene.draw (52 primitives)", frame, len(scene), frames)
+
+
+def bench_steroid(game, asteroids, particles, frames, world=False):
+    import steroid
+
+    rnd = random.Random(42)
+    random.seed(42)
+    steroid.game = game
+    steroid.game_objects = []
+    world = steroid.use_world(world) is not None
+
+    for i in range(asteroids):
+        ast = steroid.Asteroid("ASTEROID_{}".format(i), rnd.randint(0, steroid.SPACE_X),
+                               rnd.randint(0, steroid.SPACE_Y), rnd.random() * 2 * math.pi)
+        ast.width = rnd.randint(steroid.AsteroidManager.MIN_SIZE, steroid.AsteroidManager.MAX_SIZE) / 3
+        ast.movement_vector.angle.value = rnd.random() * 2 * math.pi
+        ast.movement_vector.value = steroid.Asteroid.START_SPEED
+        ast.moment = rnd.random() * 0.01
+
+    for i in range(particles):
+        particle = steroid.Particle("PART", False, rnd.randint(0, steroid.SPACE_X),
+                                    rnd.randint(0, steroid.SPACE_Y), rnd.random() * 2 * math.pi)
+        particle.width = 10
+        particle.movement_vector.angle.value = rnd.random() * 2 * math.pi
+        particle.movement_vector.value = rnd.randint(1, 10)
+
+    def frame():
+        steroid.update_world(game)
+        game.refresh()
+
+    return measure("steroid frame ({} asteroids, {} particles{})".format(asteroids, particles, ", world" if world else ""),
+                   frame, 1, frames)
+
+
+def run(args):
+    sink = socket.socket(type=socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))
+    game = loopback_game(sink, args.batching, args.optimize)
+    results = []
+
+    results.append(bench_receive_keys())
+    results.append(bench_receive_commands(game, sink, frames=args.frames))
+    results.extend(bench_draw(game, args.frames))
+    results.extend(bench_font(game, args.frames))
+    results.append(bench_scene(game, args.frames))
+    results.append(bench_steroid(game, args.asteroids, args.particles, args.steroid_frames))
+    if args.world:
+        results.append(bench_steroid(game, args.asteroids, args.particles, args.steroid_frames, world=True))
+
+    sink.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EdgeLaser client benchmarks")
+    parser.add_argument('--frames', type=int, default=300, help="frames measured per benchmark")
+    parser.add_argument('--batching', action='store_true', help="send frames with setFrameBatching()")
+    parser.add_argument('--optimize', action='store_true', help="reorder lines with a PathOptimizer")
+    parser.add_argument('--asteroids', type=int, default=10)
+    parser.add_argument('--particles', type=int, default=20)
+    parser.add_argument('--world', action='store_true', help="also measure the steroid frame with a numpy World")
+    parser.add_argument('--steroid-frames', type=int, default=50, help="frames measured for the steroid frame")
+    parser.add_argument('--save', metavar='FILE', help="write the results as json")
+    parser.add_argument('--compare', metavar='FILE', help="fail when slower than the results saved in FILE")
+    parser.add_argument('--tolerance', type=float, default=0.15, help="allowed slowdown when comparing (default 0.15)")
+    args = parser.parse_args()
+
+    results = run(args)
+    for result in results:
+        print(result)
+
+    current = dict((result.name, result.to_dict()) for result in results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for name, values in sorted(baseline.items()):
+            if name in current:
+                ratio = current[name]['ops_per_sec'] / values['ops_per_sec']
+                if ratio < 1 - args.tolerance:
+                    regressions.append("{}: {:.0f} ops/s, baseline {:.0f} ops/s ({:+.0%})".format(
+                        name, current[name]['ops_per_sec'], values['ops_per_sec'], ratio - 1))
+
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
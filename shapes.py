@@ -11,10 +11,10 @@ posx = 450
 
 posy = 450
 
-font = EdgeLaser.LaserFont('lcd.elfc')
+font = EdgeLaser.LaserFont.load('lcd.elfc')
 
 while game.isStopped():
-    game.receiveServerCommands()
+    game.receiveServerCommands(timeout=0.1)
 
 i = 1
 while not game.isStopped():
@@ -3,10 +3,17 @@ import datetime
 import random
 import traceback
 import EdgeLaser
-import time
 import math
+import numbers
 
-game = EdgeLaser.LaserGame('EdgeSteroid')
+# numpy is optional, it moves all the game objects at once, see use_world()
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# the LaserGame, connected by main()
+game = None
 
 SPACE_X = 1000
 SPACE_Y = 1000
@@ -16,14 +23,28 @@ STATUS_DEAD=3
 STATUS_RESPAWN=4
 SPEED_LIMIT_BY_SIZE=5
 GAME_DURATION = 120
-
-game.setResolution(1000).setDefaultColor(EdgeLaser.LaserColor.LIME)
-
-game.setFrameRate(30)
+# most lines drawn per frame, explosions are simplified then dropped first
+FRAME_SEGMENTS = 500
+# side of the collision grid cells, about the size of a big asteroid
+GRID_CELL = 125
+
+BORDER_LEFT=[(0.0,0.0),(0.0, SPACE_Y)]
+BORDER_RIGHT=[(SPACE_X,0.0),(SPACE_X, SPACE_Y)]
+BORDER_BOTTOM=[(0.0,0.0),(SPACE_X, 0.0)]
+BORDER_TOP=[(0.0,SPACE_Y),(SPACE_X, SPACE_Y)]
+BORDER_LEFT_BOX=(0.0, 0.0, 0.0, SPACE_Y)
+BORDER_RIGHT_BOX=(SPACE_X, 0.0, SPACE_X, SPACE_Y)
+BORDER_BOTTOM_BOX=(0.0, 0.0, SPACE_X, 0.0)
+BORDER_TOP_BOX=(0.0, SPACE_Y, SPACE_X, SPACE_Y)
 
 # global game objects list
 game_objects = None
 score_manager = None
+# the World moving the game objects, see use_world()
+world = None
+# move the objects of main() with a World, it only pays off with hundreds
+# of them
+USE_WORLD = False
 
 class Angle(object):
     def __init__(self, value):
@@ -109,7 +130,300 @@ class Vector2D(object):
 
 
 
+class AngleView(Angle):
+    # angle of a World row. When the movement of the row is steered by its
+    # angle (see VelocityView), turning the angle turns the movement too.
+    def __init__(self, world, row):
+        self.world = world
+        self.row = row
+
+    @property
+    def value(self):
+        return float(self.world.angle[self.row])
+
+    @value.setter
+    def value(self, value):
+        world = self.world
+        if world.steered[self.row]:
+            world.set_velocity(self.row, value, world.speed(self.row))
+        world.angle[self.row] = value
+
+
+class HeadingView(Angle):
+    # direction of the velocity of a World row, turning it keeps the speed
+    def __init__(self, world, row):
+        self.world = world
+        self.row = row
+
+    @property
+    def value(self):
+        return float(self.world.heading[self.row])
+
+    @value.setter
+    def value(self, value):
+        world = self.world
+        world.set_velocity(self.row, value, world.speed(self.row))
+        if world.steered[self.row]:
+            world.angle[self.row] = value
+
+
+class VelocityView(Vector):
+    # movement vector of a World row, stored as cartesian vx, vy and the
+    # heading, which stays known when the object stops
+    def __init__(self, world, row):
+        self.world = world
+        self.row = row
+        self.heading = HeadingView(world, row)
+
+    @property
+    def angle(self):
+        return self.heading
+
+    @angle.setter
+    def angle(self, angle):
+        # giving the movement the angle of its own object steers it: the
+        # plain objects then share the same Angle, until a boost replaces
+        # the movement vector
+        world = self.world
+        world.set_velocity(self.row, Angle(angle).value, world.speed(self.row))
+        world.steered[self.row] = isinstance(angle, AngleView) and angle.world is world and angle.row == self.row
+
+    @property
+    def value(self):
+        return self.world.speed(self.row)
+
+    @value.setter
+    def value(self, value):
+        self.world.set_velocity(self.row, self.world.heading[self.row], value)
+
+    def __copy__(self):
+        return Vector(self.angle.value, self.value)
+
+
+class World(object):
+    # Structure of arrays physics for the game objects: their position,
+    # velocity, angle, moment, speed limit and booster live in numpy arrays,
+    # one row per object, and step() applies the movement of all of them at
+    # once, as their apply_movement() would. The position, angle and
+    # movement_vector properties of an attached GameObject read and write
+    # its row; width, moment and booster stay on the object and are copied
+    # to the row when set.
+    #
+    # A copy of a plain object shares the Angle and the movement Vector of
+    # the original until one of them is replaced, so a wrapping asteroid
+    # and its clone turn their common angle twice per frame. Rows do the
+    # same: turn and move give the row holding the angle and the velocity
+    # of each row, the row itself unless it shares the ones of the row it
+    # was copied from. Switching use_world() while clones are on screen
+    # gives each of them an angle and a movement of its own.
+
+    COLUMNS = ('x', 'y', 'vx', 'vy', 'heading', 'angle', 'moment', 'limit')
+    FLAGS = ('used', 'spins', 'steered', 'thrust')
+    INDEXES = ('turn', 'move')
+    # columns reached through each index
+    SHARED = dict(turn=('angle', ), move=('vx', 'vy', 'heading', 'steered'))
+
+    def __init__(self, capacity=256):
+        for name in self.COLUMNS:
+            setattr(self, name, numpy.zeros(capacity))
+        for name in self.FLAGS:
+            setattr(self, name, numpy.zeros(capacity, dtype=bool))
+        for name in self.INDEXES:
+            setattr(self, name, numpy.arange(capacity))
+        self.free = list(range(capacity - 1, -1, -1))
+        self.angles = {}
+        self.velocities = {}
+
+    def grow(self):
+        size = len(self.used)
+        for name in self.COLUMNS + self.FLAGS + self.INDEXES:
+            column = getattr(self, name)
+            grown = numpy.arange(2 * size) if name in self.INDEXES else numpy.zeros(2 * size, dtype=column.dtype)
+            grown[:size] = column
+            setattr(self, name, grown)
+        self.free.extend(range(2 * size - 1, size - 1, -1))
+
+    def attach(self, obj):
+        # give obj a row of its own, filled from its current state. A copy of
+        # an attached object shares the angle and velocity of the original.
+        original = obj.world_row
+        angle = obj.angle
+        movement = obj.movement_vector
+        x, y = obj.x, obj.y
+
+        if not self.free:
+            self.grow()
+        row = self.free.pop()
+        self.used[row] = True
+        self.spins[row] = obj.SPINS
+        self.x[row] = x
+        self.y[row] = y
+        self.moment[row] = obj.moment
+        self.thrust[row] = getattr(obj, 'booster', False)
+
+        if original is None:
+            self.turn[row] = row
+            self.move[row] = row
+            self.angle[row] = angle.value
+            self.set_velocity(row, movement.angle.value, movement.value)
+            self.steered[row] = movement.angle is angle
+        else:
+            self.turn[row] = self.turn[original]
+            self.move[row] = self.move[original]
+
+        obj.world_row = row
+        self.set_limit(obj)
+
+    def detach(self, obj):
+        # give obj back plain attributes and free its row
+        row = obj.world_row
+        self.own('turn', row)
+        self.own('move', row)
+        x, y = obj.x, obj.y
+        angle = Angle(float(self.angle[row]))
+        movement = Vector(float(self.heading[row]), self.speed(row))
+        if self.steered[row]:
+            movement.angle = angle
+
+        obj.world_row = None
+        obj.x, obj.y = x, y
+        obj.angle = angle
+        obj.movement_vector = movement
+        self.used[row] = False
+        self.free.append(row)
+
+    def own(self, index, row):
+        # row stops sharing through index ('turn' or 'move') and the rows
+        # sharing from it get a copy, like plain objects keep the Angle or
+        # Vector another one replaces
+        rows = getattr(self, index)
+        sharing = numpy.nonzero(self.used & (rows == row))[0].tolist()
+        for shared in sharing + [row]:
+            source = rows[shared]
+            if source != shared:
+                for name in self.SHARED[index]:
+                    column = getattr(self, name)
+                    column[shared] = column[source]
+                rows[shared] = shared
+
+    def angle_view(self, row):
+        row = int(self.turn[row])
+        if row not in self.angles:
+            self.angles[row] = AngleView(self, row)
+        return self.angles[row]
+
+    def velocity_view(self, row):
+        row = int(self.move[row])
+        if row not in self.velocities:
+            self.velocities[row] = VelocityView(self, row)
+        return self.velocities[row]
+
+    def set_angle(self, row, value):
+        # a new angle for row alone
+        self.own('turn', row)
+        self.angle[row] = value
+
+    def set_movement(self, row, heading, value, steered):
+        # a new movement vector for row alone
+        self.own('move', row)
+        self.set_velocity(row, heading, value)
+        self.steered[row] = steered
+
+    def set_limit(self, obj):
+        # speed limit of the row of obj, 0 when it has none
+        limit = obj.get_speed_limit() if hasattr(obj, 'width') else None
+        self.limit[obj.world_row] = limit or 0
+
+    def speed(self, row):
+        # signed speed along the heading
+        heading = self.heading[row]
+        return float(self.vx[row] * math.cos(heading) + self.vy[row] * math.sin(heading))
+
+    def set_velocity(self, row, heading, value):
+        self.heading[row] = heading
+        self.vx[row] = value * math.cos(heading)
+        self.vy[row] = value * math.sin(heading)
+
+    def step(self):
+        used = self.used
+        rows = numpy.arange(len(used))
+        shared = self.turn != rows
+
+        # Particle and Asteroid turn by their moment, normalized once like
+        # Angle.__add__. The rows turning their own angle go first, then
+        # the copies turn the angle they share with their original.
+        for spin in (numpy.nonzero(used & self.spins & ~shared)[0], numpy.nonzero(used & self.spins & shared)[0]):
+            turn = self.turn[spin]
+            angle = self.angle[turn] + self.moment[spin]
+            angle = numpy.where(angle < -math.pi, angle + 2 * math.pi,
+                                numpy.where(angle > math.pi, angle - 2 * math.pi, angle))
+            self.angle[turn] = angle
+
+        # Player booster adds a unit vector along its angle, the movement
+        # is a new vector of the row, no longer steered
+        boost = numpy.nonzero(used & self.thrust)[0]
+        for row in boost.tolist():
+            self.own('move', row)
+        if len(boost):
+            angle = self.angle[self.turn[boost]]
+            self.vx[boost] += numpy.cos(angle)
+            self.vy[boost] += numpy.sin(angle)
+            self.heading[boost] = numpy.arctan2(self.vy[boost], self.vx[boost])
+            self.steered[boost] = False
+
+        # speed limit of Player and Asteroid, no limit when 0 like
+        # get_speed_limit(), applied to the velocity the row uses
+        shared = self.move != rows
+        for limited in (numpy.nonzero(used & (self.limit != 0) & ~shared)[0],
+                        numpy.nonzero(used & (self.limit != 0) & shared)[0]):
+            move = self.move[limited]
+            limit = self.limit[limited]
+            heading = self.heading[move]
+            cos, sin = numpy.cos(heading), numpy.sin(heading)
+            speed = self.vx[move] * cos + self.vy[move] * sin
+            over = speed > limit
+            self.vx[move[over]] = (limit * cos)[over]
+            self.vy[move[over]] = (limit * sin)[over]
+
+        moving = numpy.nonzero(used)[0]
+        self.x[moving] += self.vx[self.move[moving]]
+        self.y[moving] += self.vy[self.move[moving]]
+
+
+def use_world(enabled=True):
+    # move the game objects with a numpy World from now on, or with their
+    # apply_movement() again. Returns the world, None without numpy.
+    global world
+    objects = game_objects or []
+
+    if world is not None:
+        for obj in objects:
+            if obj.world_row is not None:
+                world.detach(obj)
+        world = None
+
+    if enabled and numpy is not None:
+        world = World()
+        for obj in objects:
+            world.attach(obj)
+
+    return world
+
+
 class GameObject(object):
+    # draw priority when the frame is over budget, see EdgeLaser.FrameBudget
+    PRIORITY = 0
+    # World.step() adds the moment to the angle, like apply_movement()
+    SPINS = False
+    # row of the object in the World, see use_world()
+    world_row = None
+    _moment = 0.0
+    # outline(width, rnd_factor1, rnd_factor2) gives the vertices of the
+    # polygon around the object, nose along x, see draw_objects()
+    outline = None
+    rnd_factor1 = 0.0
+    rnd_factor2 = 0.0
+
     def __init__(self,ident,x,y,angle,color=EdgeLaser.LaserColor.LIME):
         self.time_limit = 0
         self.x=x
@@ -124,10 +438,111 @@ class GameObject(object):
         self.display=True
         self.creation_date=datetime.datetime.now()
         game_objects.append(self)
+        if world is not None:
+            world.attach(self)
+
+    @property
+    def x(self):
+        if self.world_row is None:
+            return self._x
+        return float(world.x[self.world_row])
+
+    @x.setter
+    def x(self, value):
+        if self.world_row is None:
+            self._x = value
+        else:
+            world.x[self.world_row] = value
+
+    @property
+    def y(self):
+        if self.world_row is None:
+            return self._y
+        return float(world.y[self.world_row])
+
+    @y.setter
+    def y(self, value):
+        if self.world_row is None:
+            self._y = value
+        else:
+            world.y[self.world_row] = value
+
+    @property
+    def angle(self):
+        if self.world_row is None:
+            return self._angle
+        return world.angle_view(self.world_row)
+
+    @angle.setter
+    def angle(self, angle):
+        if self.world_row is None:
+            self._angle = angle
+        elif angle is not self.angle:
+            world.set_angle(self.world_row, Angle(angle).value)
+
+    @property
+    def movement_vector(self):
+        if self.world_row is None:
+            return self._movement_vector
+        return world.velocity_view(self.world_row)
+
+    @movement_vector.setter
+    def movement_vector(self, vector):
+        if self.world_row is None:
+            self._movement_vector = vector
+        elif vector is not self.movement_vector:
+            world.set_movement(self.world_row, vector.angle.value, vector.value, vector.angle is self.angle)
+
+    @property
+    def width(self):
+        return self._width
+
+    @width.setter
+    def width(self, value):
+        self._width = value
+        if self.world_row is not None:
+            world.set_limit(self)
+
+    @property
+    def moment(self):
+        return self._moment
+
+    @moment.setter
+    def moment(self, value):
+        self._moment = value
+        if self.world_row is not None:
+            world.moment[self.world_row] = value
+
+    @property
+    def polygon(self):
+        return self._polygon
+
+    @polygon.setter
+    def polygon(self, points):
+        # draw() sets the polygon once per frame, its bounding box and
+        # bounding circle are computed along for the collision early outs
+        self._polygon = points
+        self.bbox = bounds(points)
+        if self.bbox is None:
+            self.bound_center = None
+            self.bound_radius = 0.0
+        else:
+            cx = (self.bbox[0] + self.bbox[2]) / 2.0
+            cy = (self.bbox[1] + self.bbox[3]) / 2.0
+            self.bound_center = (cx, cy)
+            self.bound_radius = max(math.hypot(pt[0] - cx, pt[1] - cy) for pt in points)
 
     def get_age_in_seconds(self):
         return (datetime.datetime.now()-self.creation_date).total_seconds()
 
+    def update_status(self):
+        # called once per frame before the polygon is computed
+        pass
+
+    def draw(self, game):
+        self.update_status()
+        draw_objects([self])
+
     def get_speed_limit(self):
         return None
 
@@ -137,6 +552,8 @@ class GameObject(object):
     def unclone(self):
         if game_objects.count(self.current_clone):
             game_objects.remove(self.current_clone)
+            if self.current_clone.world_row is not None:
+                world.detach(self.current_clone)
         self.current_clone.clone_of = None
         self.current_clone = None
         self.on_unclone()
@@ -156,6 +573,15 @@ class GameObject(object):
     def stop(self):
         self.movement_vector=Vector(self.angle,0.0)
 
+    def __copy__(self):
+        # copies share the angle and movement of the original, in a World
+        # through their row, see World
+        cp = object.__new__(type(self))
+        cp.__dict__.update(self.__dict__)
+        if self.world_row is not None:
+            world.attach(cp)
+        return cp
+
     def is_clone(self):
         return self.clone_of is not None
 
@@ -163,22 +589,20 @@ class GameObject(object):
         return self.current_clone is not None
 
     def is_visible(self):
-        min_x = min(pt[0] for pt in self.polygon)
-        if min_x > SPACE_X :
-            return False
-        max_x = max(pt[0] for pt in self.polygon)
-        if max_x < 0 :
-            return False
-        min_y = min(pt[1] for pt in self.polygon)
-        if min_y > SPACE_Y :
-            return False
-        max_y = max(pt[1] for pt in self.polygon)
-        if max_y < 0 :
-            return False
-        return True
+        min_x, min_y, max_x, max_y = self.bbox
+        return not (min_x > SPACE_X or max_x < 0 or min_y > SPACE_Y or max_y < 0)
 
-    def intersects(self,poly):
+    def intersects(self,poly,bbox=None):
+        # bbox is the bounding box of poly when already known
         assert poly is not None, "{} polygon is empty".format(poly)
+        if bbox is None:
+            bbox = bounds(poly)
+        if not boxes_overlap(self.bbox, bbox):
+            return False
+
+        if numpy is not None:
+            return polygons_intersect(self.polygon, poly)
+
         for ptA1,ptA2 in poly_points_closed(self.polygon):
             vA1=Vector2D(*ptA1)
             vA2=Vector2D(*ptA2)
@@ -193,7 +617,12 @@ class GameObject(object):
     def is_colliding(self, other):
         assert other.polygon is not None, "{} polygon is None".format(other.ident)
         assert len(other.polygon) > 0, "{} polygon is empty".format(other.ident)
-        return self.intersects(other.polygon)
+        if self.bound_center is not None:
+            distance = math.hypot(self.bound_center[0] - other.bound_center[0],
+                                  self.bound_center[1] - other.bound_center[1])
+            if distance > self.bound_radius + other.bound_radius:
+                return False
+        return self.intersects(other.polygon, other.bbox)
 
     def distance(self, other):
         return math.sqrt((self.x-other.x)**2 + (self.y-other.y)**2)
@@ -209,6 +638,8 @@ class GameObject(object):
 
     def destroy(self):
         game_objects.remove(self)
+        if self.world_row is not None:
+            world.detach(self)
 
     def on_screen_wrap(self):
         pass
@@ -237,6 +668,21 @@ class GameObject(object):
             self.destroy()
 
 
+def bounds(points):
+    # axis aligned bounding box (min_x, min_y, max_x, max_y) of points
+    if len(points) == 0:
+        return None
+    xs = [pt[0] for pt in points]
+    ys = [pt[1] for pt in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def boxes_overlap(box1, box2):
+    if box1 is None or box2 is None:
+        return False
+    return not (box1[0] > box2[2] or box2[0] > box1[2] or box1[1] > box2[3] or box2[1] > box1[3])
+
+
 def apply_rot(angle,x,y):
     return x*math.cos(angle)-y*math.sin(angle) , x*math.sin(angle)+y*math.cos(angle)
 
@@ -244,6 +690,79 @@ def apply_rot(angle,x,y):
 def apply_trans(obj,x,y):
     return obj.x+x,obj.y+y
 
+
+def truncate(value):
+    # int() of a number or of every element of an array
+    if numpy is not None and isinstance(value, numpy.ndarray):
+        return numpy.trunc(value)
+    return int(value)
+
+
+def draw_objects(objects):
+    # Compute the polygon of every object from the outline of its class, in
+    # one numpy pass: outlines are evaluated per class on arrays of widths,
+    # triangles are padded with their first vertex to four vertices, then
+    # all vertices are rotated and moved at once. The polygons are views
+    # into the shared vertices array, bounding boxes and circles are
+    # computed along. Returns the (N, 4, 2) vertices, one row per object
+    # with an outline, in the order of objects.
+    objects = [obj for obj in objects if obj.outline is not None]
+    if not objects:
+        return None
+
+    if numpy is None:
+        for obj in objects:
+            outline = obj.outline(obj.width, obj.rnd_factor1, obj.rnd_factor2)
+            obj.polygon = [apply_trans(obj, *apply_rot(obj.angle.value, *pt)) for pt in outline]
+        return None
+
+    # widths of a batch share their type, Python 2 divides integer widths
+    # like the scalar outlines did
+    groups = {}
+    for i, obj in enumerate(objects):
+        key = (type(obj), isinstance(obj.width, numbers.Integral))
+        groups.setdefault(key, []).append(i)
+
+    local_x = numpy.empty((len(objects), 4))
+    local_y = numpy.empty((len(objects), 4))
+    counts = [0] * len(objects)
+    for (cls, integral), rows in groups.items():
+        members = [objects[i] for i in rows]
+        outline = cls.outline(numpy.array([obj.width for obj in members]),
+                              numpy.array([obj.rnd_factor1 for obj in members]),
+                              numpy.array([obj.rnd_factor2 for obj in members]))
+        xs = numpy.empty((len(members), 4))
+        ys = numpy.empty((len(members), 4))
+        for i, (x, y) in enumerate(outline):
+            xs[:, i] = x
+            ys[:, i] = y
+        xs[:, len(outline):] = xs[:, :1]
+        ys[:, len(outline):] = ys[:, :1]
+        local_x[rows] = xs
+        local_y[rows] = ys
+        for i in rows:
+            counts[i] = len(outline)
+
+    angles = numpy.array([obj.angle.value for obj in objects])
+    cos = numpy.cos(angles)[:, None]
+    sin = numpy.sin(angles)[:, None]
+    xs = local_x * cos - local_y * sin + numpy.array([obj.x for obj in objects], dtype=float)[:, None]
+    ys = local_x * sin + local_y * cos + numpy.array([obj.y for obj in objects], dtype=float)[:, None]
+    vertices = numpy.dstack((xs, ys))
+
+    boxes = numpy.column_stack((xs.min(1), ys.min(1), xs.max(1), ys.max(1)))
+    centers = (boxes[:, :2] + boxes[:, 2:]) / 2.0
+    radii = numpy.hypot(xs - centers[:, :1], ys - centers[:, 1:]).max(1)
+
+    for obj, polygon, count, box, center, radius in zip(objects, vertices, counts, boxes.tolist(),
+                                                        centers.tolist(), radii.tolist()):
+        obj._polygon = polygon[:count]
+        obj.bbox = tuple(box)
+        obj.bound_center = tuple(center)
+        obj.bound_radius = radius
+
+    return vertices
+
 def determinant(vec1,vec2):
     return vec1.x*vec2.y-vec1.y*vec2.x
 
@@ -259,6 +778,85 @@ def lines_intersect(a,b,c,d):
         return None
     return a*(1-t)+t*b
 
+
+def polygon_edges(points):
+    # starts and ends of the edges of a closed polygon, as (n, 2) arrays
+    starts = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    return starts, numpy.concatenate((starts[1:], starts[:1]))
+
+
+def segments_intersect(a, b, c, d, points=False):
+    # lines_intersect() of the segments a-b and c-d over arrays of points of
+    # shape (..., 2), broadcast against each other: parallel segments never
+    # hit, segments touching at an end do. Returns the hit flags, and with
+    # points the intersection points too, nan where there is no hit.
+    ab = b - a
+    cd = c - d
+    ca = c - a
+    det = ab[..., 0] * cd[..., 1] - ab[..., 1] * cd[..., 0]
+    parallel = det == 0
+    det = numpy.where(parallel, 1.0, det)
+    t = (ca[..., 0] * cd[..., 1] - ca[..., 1] * cd[..., 0]) / det
+    u = (ab[..., 0] * ca[..., 1] - ab[..., 1] * ca[..., 0]) / det
+    hits = ~parallel & (t >= 0) & (u >= 0) & (t <= 1) & (u <= 1)
+
+    if not points:
+        return hits
+
+    t = numpy.where(hits, t, numpy.nan)[..., None]
+    return hits, a * (1 - t) + t * b
+
+
+def polygons_intersect(poly1, poly2):
+    # whether an edge of the closed polygon poly1 crosses an edge of poly2,
+    # all the edge pairs tested at once
+    a, b = polygon_edges(poly1)
+    c, d = polygon_edges(poly2)
+    return bool(segments_intersect(a[:, None], b[:, None], c[None], d[None]).any())
+
+
+def colliding(pairs):
+    # is_colliding() of every (object, object) pair at once: the bounding
+    # circles in python, then the edges of all the remaining pairs in a
+    # single segments_intersect()
+    if numpy is None:
+        return [go1.is_colliding(go2) for go1, go2 in pairs]
+
+    hits = [False] * len(pairs)
+    candidates = []
+    for index, (go1, go2) in enumerate(pairs):
+        if go1.bound_center is not None:
+            distance = math.hypot(go1.bound_center[0] - go2.bound_center[0],
+                                  go1.bound_center[1] - go2.bound_center[1])
+            if distance > go1.bound_radius + go2.bound_radius:
+                continue
+        candidates.append(index)
+    if not candidates:
+        return hits
+
+    # polygons padded with their first vertex, the extra edges have no
+    # length and never hit
+    rows = {}
+    polygons = []
+    for index in candidates:
+        for obj in pairs[index]:
+            if id(obj) not in rows:
+                rows[id(obj)] = len(polygons)
+                polygons.append(numpy.asarray(obj.polygon, dtype=float).reshape(-1, 2))
+    vertices = numpy.empty((len(polygons), max(len(polygon) for polygon in polygons), 2))
+    for row, polygon in enumerate(polygons):
+        vertices[row, :len(polygon)] = polygon
+        vertices[row, len(polygon):] = polygon[0]
+    ends = numpy.concatenate((vertices[:, 1:], vertices[:, :1]), axis=1)
+
+    first = numpy.array([rows[id(pairs[index][0])] for index in candidates])
+    second = numpy.array([rows[id(pairs[index][1])] for index in candidates])
+    found = segments_intersect(vertices[first][:, :, None], ends[first][:, :, None],
+                               vertices[second][:, None], ends[second][:, None])
+    for index, hit in zip(candidates, found.reshape(len(candidates), -1).any(axis=1).tolist()):
+        hits[index] = hit
+    return hits
+
 class Fire(GameObject):
     def __init__(self,ident,player,*args,**kwargs):
         GameObject.__init__(self,ident,*args,**kwargs)
@@ -269,20 +867,9 @@ class Fire(GameObject):
         self.polygon=[]
         self.time_limit=3.5
 
-    def draw(self, game):
-        p1=(0,-self.width/2)
-        p2=(self.width/2,0)
-        p3=(0,self.width/2)
-
-        p1=apply_rot(self.angle.value,*p1)
-        p2=apply_rot(self.angle.value,*p2)
-        p3=apply_rot(self.angle.value,*p3)
-
-        p1=apply_trans(self,*p1)
-        p2=apply_trans(self,*p2)
-        p3=apply_trans(self,*p3)
-
-        self.polygon=[p1,p2,p3]
+    @staticmethod
+    def outline(width, rnd_factor1, rnd_factor2):
+        return [(0,-width/2), (width/2,0), (0,width/2)]
 
     def collide(self, other):
         if isinstance(other, Player):
@@ -312,6 +899,9 @@ class Fire(GameObject):
 
 
 class Player(GameObject):
+    PRIORITY = 1
+    _booster = False
+
     def __init__(self,ident,*args,**kwargs):
         GameObject.__init__(self,ident,*args,**kwargs)
         self.score = 0
@@ -328,6 +918,16 @@ class Player(GameObject):
     # def get_poly(self):
     #     if
 
+    @property
+    def booster(self):
+        return self._booster
+
+    @booster.setter
+    def booster(self, value):
+        self._booster = value
+        if self.world_row is not None:
+            world.thrust[self.world_row] = bool(value)
+
     def get_speed_limit(self):
         return self.width/SPEED_LIMIT_BY_SIZE
 
@@ -336,7 +936,7 @@ class Player(GameObject):
         explode(self,3,True,3)
         self.stop()
 
-    def draw(self, game):
+    def update_status(self):
         if self.status==STATUS_DYING :
             if self.width > 0:
                 self.width-=3
@@ -345,19 +945,9 @@ class Player(GameObject):
                 self.status=STATUS_DEAD
                 self.destroy()
 
-        p1=(0,-self.width/4)
-        p2=(self.width,0)
-        p3=(0,self.width/4)
-
-        p1=apply_rot(self.angle.value,*p1)
-        p2=apply_rot(self.angle.value,*p2)
-        p3=apply_rot(self.angle.value,*p3)
-
-        p1=apply_trans(self,*p1)
-        p2=apply_trans(self,*p2)
-        p3=apply_trans(self,*p3)
-
-        self.polygon=[p1,p2,p3]
+    @staticmethod
+    def outline(width, rnd_factor1, rnd_factor2):
+        return [(0,-width/4), (width,0), (0,width/4)]
 
 
     def apply_movement(self):
@@ -395,8 +985,46 @@ def poly_points_closed(points):
     yield points[-1],points[0]
 
 def draw_poly(game, game_obj):
-    for pt1,pt2 in poly_points_closed(game_obj.polygon):
-        game.addLine(pt1[0],pt1[1],pt2[0],pt2[1], game_obj.color)
+    game.addPolygon(game_obj.polygon, game_obj.color, game_obj.PRIORITY)
+
+def draw_frame(game, objects, vertices):
+    # Draw the polygons of the game objects with one addLinesArray() per
+    # color and priority, so each group is clipped in one numpy pass, and
+    # held back as one primitive per object for the frame budget. objects
+    # and vertices are the ones of draw_objects(), the objects added since
+    # (clones, explosions) bring their own polygons.
+    if vertices is None:
+        for game_obj in game_objects:
+            draw_poly(game, game_obj)
+        return
+
+    rows = dict((id(obj), i) for i, obj in enumerate(obj for obj in objects if obj.outline is not None))
+    groups = {}
+    for game_obj in game_objects:
+        polygon = game_obj.polygon
+        count = len(polygon)
+        if count < 2 or count > 4:
+            draw_poly(game, game_obj)
+            continue
+        drawn, added = groups.setdefault((game_obj.color, game_obj.PRIORITY), (([], []), ([], [])))
+        row = rows.get(id(game_obj))
+        if row is not None and getattr(polygon, 'base', None) is vertices:
+            drawn[0].append(row)
+            drawn[1].append(count)
+        else:
+            # padded with the first vertex like the vertices of draw_objects()
+            polygon = [tuple(point) for point in polygon]
+            added[0].append(polygon + polygon[:1] * (4 - count))
+            added[1].append(count)
+
+    for (color, priority), (drawn, added) in groups.items():
+        polygons = vertices[drawn[0]]
+        if added[0]:
+            polygons = numpy.concatenate((polygons, numpy.array(added[0], dtype=float)))
+        counts = drawn[1] + added[1]
+        lines = numpy.concatenate((polygons, numpy.roll(polygons, -1, axis=1)), axis=2)
+        edges = numpy.arange(4) < numpy.array(counts)[:, None]
+        game.addLinesArray(lines[edges], color, priority=priority, counts=counts)
 
 def explode(obj, particle_count,growing=False,time_limit=3):
 
@@ -410,6 +1038,8 @@ def explode(obj, particle_count,growing=False,time_limit=3):
 
 class Particle(GameObject):
     START_SPEED = 2.0
+    PRIORITY = -1
+    SPINS = True
 
     def __init__(self,ident,growing=False,*args,**kwargs):
         GameObject.__init__(self,ident,*args,**kwargs)
@@ -424,26 +1054,14 @@ class Particle(GameObject):
         self.width=1
 
 
-    def draw(self, game):
+    def update_status(self):
         if self.growing:
             self.width=self.get_age_in_seconds()*3
 
-        p1=(0,-int(self.width/3*self.rnd_factor2))
-        p2=(self.width/2,0)
-        p3=(0,self.width/5)
-        p4=(-int(self.width/2*self.rnd_factor1),self.width/4)
-
-        p1=apply_rot(self.angle.value,*p1)
-        p2=apply_rot(self.angle.value,*p2)
-        p3=apply_rot(self.angle.value,*p3)
-        p4=apply_rot(self.angle.value,*p4)
-
-        p1=apply_trans(self,*p1)
-        p2=apply_trans(self,*p2)
-        p3=apply_trans(self,*p3)
-        p4=apply_trans(self,*p4)
-
-        self.polygon=[p1,p2,p3,p4]
+    @staticmethod
+    def outline(width, rnd_factor1, rnd_factor2):
+        return [(0,-truncate(width/3*rnd_factor2)), (width/2,0), (0,width/5),
+                (-truncate(width/2*rnd_factor1),width/4)]
 
 
     def apply_movement(self):
@@ -452,6 +1070,7 @@ class Particle(GameObject):
 
 class Asteroid(GameObject):
     START_SPEED = 2.0
+    SPINS = True
 
     def __init__(self,ident,*args,**kwargs):
         GameObject.__init__(self,ident,*args,**kwargs)
@@ -470,23 +1089,10 @@ class Asteroid(GameObject):
         self.stop()
         self.destroy()
 
-    def draw(self, game):
-        p1=(0,-int(self.width/3*self.rnd_factor2))
-        p2=(self.width/2,0)
-        p3=(0,self.width/5)
-        p4=(-int(self.width/2*self.rnd_factor1),self.width/4)
-
-        p1=apply_rot(self.angle.value,*p1)
-        p2=apply_rot(self.angle.value,*p2)
-        p3=apply_rot(self.angle.value,*p3)
-        p4=apply_rot(self.angle.value,*p4)
-
-        p1=apply_trans(self,*p1)
-        p2=apply_trans(self,*p2)
-        p3=apply_trans(self,*p3)
-        p4=apply_trans(self,*p4)
-
-        self.polygon=[p1,p2,p3,p4]
+    @staticmethod
+    def outline(width, rnd_factor1, rnd_factor2):
+        return [(0,-truncate(width/3*rnd_factor2)), (width/2,0), (0,width/5),
+                (-truncate(width/2*rnd_factor1),width/4)]
 
     def collide(self, other):
         if isinstance(other, Player):
@@ -616,14 +1222,16 @@ class ScoreManager(object):
 
 
 def double_scroll(text1, text2):
-    font = EdgeLaser.LaserFont('lcd.elfc')
+    font = EdgeLaser.LaserFont.load('lcd.elfc')
+    text1 = font.compile(text1, coeff=20)
+    text2 = font.compile(text2, coeff=20)
     #
     i=0
 
     while i < 3000 and not game.isStopped() :
         game.newFrame()
-        font.render(game, text1, i-500, 500, coeff=20)
-        font.render(game, text2, 500-i, 700, coeff=20)
+        text1.draw(game, i-500, 500)
+        text2.draw(game, 500-i, 700)
 
         game.refresh()
         game.endFrame()
@@ -658,185 +1266,267 @@ def intro_screen():
 
 
 def double_display(text1, text2):
-    font = EdgeLaser.LaserFont('lcd.elfc')
+    font = EdgeLaser.LaserFont.load('lcd.elfc')
+    text1 = font.compile(text1, coeff=20, spacing_factor=3)
+    text2 = font.compile(text2, coeff=20, spacing_factor=3)
     #
     i=0
 
     while not game.isStopped() and i < 3000 :
         game.newFrame()
-        font.render(game, text1, 1, 500, coeff=20, spacing_factor=3)
-        font.render(game, text2, 1, 700, coeff=20, spacing_factor=3)
+        text1.draw(game, 1, 500)
+        text2.draw(game, 1, 700)
 
         game.refresh()
         game.endFrame()
         i+=25
 
 
-while True:
-    game_objects = []
+class SpatialGrid(object):
+    # Uniform grid over the field for the collision broad phase: objects are
+    # put in the cells their bounding box covers, and pairs() yields the
+    # pairs of objects whose boxes overlap, each unordered pair once, in the
+    # order of the objects list. Objects beyond the field (clones across a
+    # border) fall in the border cells.
 
-    while game.isStopped():
-        game.receiveServerCommands()
-        time.sleep(0.1)
+    def __init__(self, cell=GRID_CELL):
+        self.cell = float(cell)
+        self.columns = max(1, int(math.ceil(SPACE_X / self.cell)))
+        self.rows = max(1, int(math.ceil(SPACE_Y / self.cell)))
+
+    def column(self, x):
+        return min(max(int(x // self.cell), 0), self.columns - 1)
+
+    def row(self, y):
+        return min(max(int(y // self.cell), 0), self.rows - 1)
+
+    def pairs(self, objects):
+        cells = {}
+        boxes = []
+        for index, obj in enumerate(objects):
+            box = obj.bbox
+            boxes.append(box)
+            if box is None:
+                continue
+            for column in range(self.column(box[0]), self.column(box[2]) + 1):
+                for row in range(self.row(box[1]), self.row(box[3]) + 1):
+                    cells.setdefault((column, row), []).append(index)
+
+        pairs = []
+        for (column, row), members in cells.items():
+            for a in range(len(members)):
+                i = members[a]
+                box1 = boxes[i]
+                for b in range(a + 1, len(members)):
+                    j = members[b]
+                    box2 = boxes[j]
+                    if not boxes_overlap(box1, box2):
+                        continue
+                    # report the pair only from the cell holding the corner
+                    # where the boxes start to overlap
+                    if self.column(max(box1[0], box2[0])) == column and self.row(max(box1[1], box2[1])) == row:
+                        pairs.append((i, j))
+
+        pairs.sort()
+        return [(objects[i], objects[j]) for i, j in pairs]
+
+
+def collide_objects(objects):
+    # test the candidate pairs of the broad phase, each pair once, and let
+    # both objects of a colliding pair react, unless one of them was
+    # destroyed by an earlier collision of the frame
+    alive = set(id(obj) for obj in objects)
+    pairs = SpatialGrid().pairs(objects)
+    for (go1, go2), hit in zip(pairs, colliding(pairs)):
+        if id(go1) not in alive or id(go2) not in alive:
+            continue
+        if hit:
+            go1.collide(go2)
+            alive = set(id(obj) for obj in game_objects)
+            if id(go1) in alive and id(go2) in alive:
+                go2.collide(go1)
+                alive = set(id(obj) for obj in game_objects)
+
+
+def update_world(game):
+    # move, draw and collide every game object for one frame
+    if world is not None:
+        world.step()
+    else:
+        for game_obj in game_objects:
+            game_obj.apply_movement()
 
-    # intro screen
 
-    intro_screen()
+    objects = list(game_objects)
+    for game_obj in objects:
+        game_obj.update_status()
+    vertices = draw_objects(objects)
 
-    game_start_time = datetime.datetime.now()
+    collide_objects(list(game_objects))
 
+    no_clone_objects = [obj for obj in game_objects if not obj.is_clone()]
 
-    player1 = Player("PLAYER1",300,500,math.pi/2,color=EdgeLaser.LaserColor.WHITE)
-    player2 = Player("PLAYER2",600,500,math.pi/2,color=EdgeLaser.LaserColor.CYAN)
+    for game_obj in no_clone_objects:
 
-    dangle=0.1
+        crossing = False
 
-    BORDER_LEFT=[(0.0,0.0),(0.0, SPACE_Y)]
-    BORDER_RIGHT=[(SPACE_X,0.0),(SPACE_X, SPACE_Y)]
-    BORDER_BOTTOM=[(0.0,0.0),(SPACE_X, 0.0)]
-    BORDER_TOP=[(0.0,SPACE_Y),(SPACE_X, SPACE_Y)]
+        if game_obj.intersects(BORDER_RIGHT, BORDER_RIGHT_BOX):
+            game_obj.on_screen_wrap()
+            the_clone = game_obj.clone()
+            the_clone.x = game_obj.x - SPACE_X
+            the_clone.y = game_obj.y
+            crossing = True
 
-    am=AsteroidManager()
-    score_manager = ScoreManager()
+        elif game_obj.intersects(BORDER_LEFT, BORDER_LEFT_BOX):
+            game_obj.on_screen_wrap()
+            the_clone = game_obj.clone()
+            the_clone.x = game_obj.x + SPACE_X
+            the_clone.y = game_obj.y
+            crossing = True
 
-    place_object_in_field(player1,300,700)
-    place_object_in_field(player2,300,700)
+        elif game_obj.intersects(BORDER_TOP, BORDER_TOP_BOX):
+            game_obj.on_screen_wrap()
+            the_clone = game_obj.clone()
+            the_clone.x = game_obj.x
+            the_clone.y = game_obj.y - SPACE_Y
+            crossing = True
 
-    player1.movement_vector.value=random.randint(1,3)
-    player1.movement_vector.angle=player1.angle
-    player2.movement_vector.value=random.randint(1,3)
-    player2.movement_vector.angle=player2.angle
+        elif game_obj.intersects(BORDER_BOTTOM, BORDER_BOTTOM_BOX):
+            game_obj.on_screen_wrap()
+            the_clone = game_obj.clone()
+            the_clone.x = game_obj.x
+            the_clone.y = game_obj.y + SPACE_Y
+            crossing = True
 
+        if not game_obj.is_visible() and game_obj.has_clone() :
+            game_obj.x = game_obj.current_clone.x
+            game_obj.y = game_obj.current_clone.y
+            game_obj.unclone()
 
-    while not game.isStopped():
+        if game_obj.is_visible() and game_obj.has_clone() and not crossing:
+            game_obj.unclone()
 
-        try:
+        if game_obj.x < -500 or game_obj.x > SPACE_X+500 or game_obj.y < -500 or game_obj.y > SPACE_Y+500:
+            if game_obj.has_clone():
+                game_obj.unclone()
 
-            game_duration = (datetime.datetime.now() - game_start_time).total_seconds()
+            place_object_in_field(game_obj)
 
-            winner_bonus = (GAME_DURATION - game_duration) * 100
 
-            game.newFrame()
+    draw_frame(game, objects, vertices)
 
-            game.receiveServerCommands()
+    for game_obj in game_objects:
+        assert isinstance(game_obj, GameObject)
+        game_obj.expire()
 
-            if game.player1_keys:
-                if game.player1_keys.xn :
-                    player1.angle.add(-dangle)
-                elif game.player1_keys.xp :
-                    player1.angle.add(dangle)
 
-                player1.booster = game.player1_keys.a
-                player1.fire =    game.player1_keys.b
+def main():
+    global game, game_objects, score_manager
 
-            if game.player2_keys:
-                if game.player2_keys.xn :
-                    player2.angle.add(-dangle)
-                elif game.player2_keys.xp :
-                    player2.angle.add(dangle)
+    game = EdgeLaser.LaserGame('EdgeSteroid')
 
-                player2.booster = game.player2_keys.a
-                player2.fire =    game.player2_keys.b
+    game.setResolution(1000).setDefaultColor(EdgeLaser.LaserColor.LIME)
 
-            for player in [player1, player2] :
-                player.do_fire()
+    game.setFrameRate(30)
+    game.setFrameBudget(EdgeLaser.FrameBudget(max_segments=FRAME_SEGMENTS))
 
-            am.manage_asteroids(game_objects)
+    while True:
+        game_objects = []
+        use_world(USE_WORLD)
 
-            for game_obj in game_objects:
-                game_obj.apply_movement()
+        while game.isStopped():
+            game.receiveServerCommands(timeout=0.1)
 
+        # intro screen
 
-            for game_obj in game_objects:
-                game_obj.draw(game)
+        intro_screen()
 
-            for go1 in game_objects:
-                assert(go1.polygon is not None)
-                for go2 in game_objects:
-                    assert(go2.polygon is not None)
-                    if go1 is not go2 :
-                        if go1.is_colliding(go2):
-                            go1.collide(go2)
+        game_start_time = datetime.datetime.now()
 
-            no_clone_objects = [obj for obj in game_objects if not obj.is_clone()]
 
-            for game_obj in no_clone_objects:
+        player1 = Player("PLAYER1",300,500,math.pi/2,color=EdgeLaser.LaserColor.WHITE)
+        player2 = Player("PLAYER2",600,500,math.pi/2,color=EdgeLaser.LaserColor.CYAN)
 
-                crossing = False
+        dangle=0.1
 
-                if game_obj.intersects(BORDER_RIGHT):
-                    game_obj.on_screen_wrap()
-                    the_clone = game_obj.clone()
-                    the_clone.x = game_obj.x - SPACE_X
-                    the_clone.y = game_obj.y
-                    crossing = True
+        am=AsteroidManager()
+        score_manager = ScoreManager()
 
-                elif game_obj.intersects(BORDER_LEFT):
-                    game_obj.on_screen_wrap()
-                    the_clone = game_obj.clone()
-                    the_clone.x = game_obj.x + SPACE_X
-                    the_clone.y = game_obj.y
-                    crossing = True
+        place_object_in_field(player1,300,700)
+        place_object_in_field(player2,300,700)
 
-                elif game_obj.intersects(BORDER_TOP):
-                    game_obj.on_screen_wrap()
-                    the_clone = game_obj.clone()
-                    the_clone.x = game_obj.x
-                    the_clone.y = game_obj.y - SPACE_Y
-                    crossing = True
+        player1.movement_vector.value=random.randint(1,3)
+        player1.movement_vector.angle=player1.angle
+        player2.movement_vector.value=random.randint(1,3)
+        player2.movement_vector.angle=player2.angle
 
-                elif game_obj.intersects(BORDER_BOTTOM):
-                    game_obj.on_screen_wrap()
-                    the_clone = game_obj.clone()
-                    the_clone.x = game_obj.x
-                    the_clone.y = game_obj.y + SPACE_Y
-                    crossing = True
 
-                if not game_obj.is_visible() and game_obj.has_clone() :
-                    game_obj.x = game_obj.current_clone.x
-                    game_obj.y = game_obj.current_clone.y
-                    game_obj.unclone()
+        while not game.isStopped():
 
-                if game_obj.is_visible() and game_obj.has_clone() and not crossing:
-                    game_obj.unclone()
+            try:
 
-                if game_obj.x < -500 or game_obj.x > SPACE_X+500 or game_obj.y < -500 or game_obj.y > SPACE_Y+500:
-                    if game_obj.has_clone():
-                        game_obj.unclone()
+                game_duration = (datetime.datetime.now() - game_start_time).total_seconds()
 
-                    place_object_in_field(game_obj)
+                winner_bonus = (GAME_DURATION - game_duration) * 100
 
+                game.newFrame()
 
-            for game_obj in game_objects:
-                draw_poly(game, game_obj)
-                assert isinstance(game_obj, GameObject)
-                game_obj.expire()
+                game.receiveServerCommands()
 
-            game.refresh()
+                if game.player1_keys:
+                    if game.player1_keys.xn :
+                        player1.angle.add(-dangle)
+                    elif game.player1_keys.xp :
+                        player1.angle.add(dangle)
 
-            game.endFrame()
+                    player1.booster = game.player1_keys.a
+                    player1.fire =    game.player1_keys.b
 
-            exists_particle = any(( isinstance(o, Particle) for o in game_objects))
+                if game.player2_keys:
+                    if game.player2_keys.xn :
+                        player2.angle.add(-dangle)
+                    elif game.player2_keys.xp :
+                        player2.angle.add(dangle)
 
-            if player1.status==STATUS_DEAD or player2.status==STATUS_DEAD and not exists_particle:
-                print("Player1: {} Player2: {}".format(player1.score, player2.score))
+                    player2.booster = game.player2_keys.a
+                    player2.fire =    game.player2_keys.b
 
-                if player2.status==STATUS_DEAD and player1.status==STATUS_ALIVE :
-                    double_display("P 1","WINS")
-                elif player1.status==STATUS_DEAD and player2.status==STATUS_ALIVE :
-                    double_display("P 2","WINS")
-                else:
-                    double_display("DRAW","")
+                for player in [player1, player2] :
+                    player.do_fire()
 
+                am.manage_asteroids(game_objects)
 
+                update_world(game)
+
+                game.refresh()
+
+                game.endFrame()
+
+                exists_particle = any(( isinstance(o, Particle) for o in game_objects))
+
+                if player1.status==STATUS_DEAD or player2.status==STATUS_DEAD and not exists_particle:
+                    print("Player1: {} Player2: {}".format(player1.score, player2.score))
+
+                    if player2.status==STATUS_DEAD and player1.status==STATUS_ALIVE :
+                        double_display("P 1","WINS")
+                    elif player1.status==STATUS_DEAD and player2.status==STATUS_ALIVE :
+                        double_display("P 2","WINS")
+                    else:
+                        double_display("DRAW","")
+
+
+                    break
+
+            except KeyboardInterrupt:
+                import pdb; pdb.set_trace()
+            except:
+                print("Got exception in game loop, restarting")
+                traceback.format_stack()
+                traceback.print_exc()
                 break
 
-        except KeyboardInterrupt:
-            import pdb; pdb.set_trace()
-        except:
-            print("Got exception in game loop, restarting")
-            traceback.format_stack()
-            traceback.print_exc()
-            break
+        game.pause()
+
 
-    game.pause()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
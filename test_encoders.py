@@ -0,0 +1,149 @@
+import itertools
+import random
+import unittest
+
+from construct import Container
+
+import EdgeLaser
+
+COORDINATES = (0, 1, 255, 256, 32767, 65534, 65535)
+BYTES = (0, 1, 127, 255)
+
+
+class CaptureGame(EdgeLaser.LaserGame):
+    # keeps the datagrams it sends instead of sending them
+    def __init__(self):
+        self.sent = []
+        EdgeLaser.LaserGame.__init__(self, 'test', '127.0.0.1', 9)
+        del self.sent[:]
+        self.gameid = 7
+
+    def sendCmd(self, data):
+        data = bytes(data) if isinstance(data, bytes) else data.tobytes()
+        self.sent.append(data)
+        return len(data)
+
+
+class EncoderTest(unittest.TestCase):
+    # the struct encoders give the same bytes as the construct packets
+
+    def assertLine(self, packet, encoder, opcode, gameid, x1, y1, x2, y2, color):
+        built = packet.build(Container(gameid=gameid, x1=x1, y1=y1, x2=x2, y2=y2, color=color))
+        self.assertEqual(encoder.pack(gameid, opcode, x1, y1, x2, y2, color), built)
+
+    def test_line(self):
+        for x1, y1, x2, y2 in itertools.product(COORDINATES, repeat=4):
+            self.assertLine(EdgeLaser.LinePacket, EdgeLaser.LineEncoder, b'L', 3, x1, y1, x2, y2, 5)
+        for gameid, color in itertools.product(BYTES, repeat=2):
+            self.assertLine(EdgeLaser.LinePacket, EdgeLaser.LineEncoder, b'L', gameid, 0, 65535, 65535, 0, color)
+
+    def test_rectangle(self):
+        for x1, y1, x2, y2 in itertools.product(COORDINATES, repeat=4):
+            self.assertLine(EdgeLaser.RectPacket, EdgeLaser.RectEncoder, b'D', 3, x1, y1, x2, y2, 5)
+        for gameid, color in itertools.product(BYTES, repeat=2):
+            self.assertLine(EdgeLaser.RectPacket, EdgeLaser.RectEncoder, b'D', gameid, 65535, 0, 0, 65535, color)
+
+    def test_circle(self):
+        for gameid, x, y, diam, color in itertools.product(BYTES, COORDINATES, COORDINATES, COORDINATES, BYTES):
+            built = EdgeLaser.CirclePacket.build(Container(gameid=gameid, x=x, y=y, diam=diam, color=color))
+            self.assertEqual(EdgeLaser.CircleEncoder.pack(gameid, b'C', x, y, diam, color), built)
+
+    def test_refresh(self):
+        for gameid in range(256):
+            built = EdgeLaser.RefreshPacket.build(Container(gameid=gameid))
+            self.assertEqual(EdgeLaser.RefreshEncoder.pack(gameid, b'R'), built)
+
+    def test_sizes(self):
+        self.assertEqual(EdgeLaser.LineEncoder.size, EdgeLaser.LinePacket.sizeof())
+        self.assertEqual(EdgeLaser.CircleEncoder.size, EdgeLaser.CirclePacket.sizeof())
+        self.assertEqual(EdgeLaser.RectEncoder.size, EdgeLaser.RectPacket.sizeof())
+        self.assertEqual(EdgeLaser.RefreshEncoder.size, EdgeLaser.RefreshPacket.sizeof())
+
+    def test_pack_into(self):
+        # packets packed one after the other in a buffer, as a batched frame
+        rnd = random.Random(1)
+        buffer = bytearray(EdgeLaser.MTU)
+        expected = b''
+        offset = 0
+        while True:
+            kind = rnd.choice('LCDR')
+            if kind == 'C':
+                values = [rnd.randint(0, 65535) for _ in range(3)]
+                encoder = EdgeLaser.CircleEncoder
+                args = [9, b'C'] + values + [255]
+                built = EdgeLaser.CirclePacket.build(Container(gameid=9, x=values[0], y=values[1], diam=values[2], color=255))
+            elif kind == 'R':
+                encoder = EdgeLaser.RefreshEncoder
+                args = [9, b'R']
+                built = EdgeLaser.RefreshPacket.build(Container(gameid=9))
+            else:
+                values = [rnd.choice((0, 65535, rnd.randint(0, 65535))) for _ in range(4)]
+                encoder = EdgeLaser.LineEncoder if kind == 'L' else EdgeLaser.RectEncoder
+                packet = EdgeLaser.LinePacket if kind == 'L' else EdgeLaser.RectPacket
+                args = [9, kind.encode('ascii')] + values + [0]
+                built = packet.build(Container(gameid=9, x1=values[0], y1=values[1], x2=values[2], y2=values[3], color=0))
+
+            if offset + encoder.size > len(buffer):
+                break
+            encoder.pack_into(buffer, offset, *args)
+            offset += encoder.size
+            expected += built
+
+        self.assertEqual(bytes(buffer[:offset]), expected)
+
+
+class BatchedFrameTest(unittest.TestCase):
+    # a batched frame holds the construct packets of its draw commands
+
+    def setUp(self):
+        # resolution 65535, coordinates are sent as they are
+        self.game = CaptureGame()
+        self.game.setResolution(65535).setFrameBatching(True)
+
+    def line(self, x1, y1, x2, y2, color=EdgeLaser.LaserColor.LIME):
+        return EdgeLaser.LinePacket.build(Container(gameid=7, x1=x1, y1=y1, x2=x2, y2=y2, color=color))
+
+    def test_frame(self):
+        game = self.game
+        game.addLine(0, 0, 65535, 65535)
+        game.addCircle(65535, 0, 70000, EdgeLaser.LaserColor.RED)
+        game.addRectangle(0, 65535, 65535, 0, EdgeLaser.LaserColor.BLUE)
+        game.refresh()
+
+        expected = (self.line(0, 0, 65535, 65535) +
+                    EdgeLaser.CirclePacket.build(Container(gameid=7, x=65535, y=0, diam=65535, color=EdgeLaser.LaserColor.RED)) +
+                    # rectangles are clipped to resolution - 1
+                    EdgeLaser.RectPacket.build(Container(gameid=7, x1=0, y1=65534, x2=65534, y2=0, color=EdgeLaser.LaserColor.BLUE)) +
+                    EdgeLaser.RefreshPacket.build(Container(gameid=7)))
+        self.assertEqual(b''.join(game.sent), expected)
+
+    def test_lines_array(self):
+        # enough lines for the numpy records, split over several datagrams
+        rnd = random.Random(2)
+        lines = [tuple(rnd.choice((0, 65535, rnd.randint(0, 65535))) for _ in range(4)) for _ in range(300)]
+        self.game.addLines(lines)
+        self.game.refresh()
+
+        expected = b''.join(self.line(*line) for line in lines) + EdgeLaser.RefreshPacket.build(Container(gameid=7))
+        self.assertEqual(b''.join(self.game.sent), expected)
+        self.assertTrue(len(self.game.sent) > 1)
+        for datagram in self.game.sent[:-1]:
+            self.assertTrue(len(datagram) <= EdgeLaser.MTU)
+            self.assertEqual(len(datagram) % EdgeLaser.LineEncoder.size, 0)
+
+    def test_small_mtu(self):
+        self.assertRaises(ValueError, self.game.setFrameBatching, True, EdgeLaser.LineEncoder.size - 1)
+
+        # one line per datagram
+        self.game.setFrameBatching(True, EdgeLaser.LineEncoder.size)
+        lines = [(i, i, 2 * i, 2 * i) for i in range(20)]
+        self.game.addLines(lines)
+        self.game.addLine(1, 2, 3, 4)
+        self.game.refresh()
+
+        expected = [self.line(*line) for line in lines + [(1, 2, 3, 4)]] + [EdgeLaser.RefreshPacket.build(Container(gameid=7))]
+        self.assertEqual(self.game.sent, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,198 @@
+import itertools
+import math
+import random
+import unittest
+
+import EdgeLaser
+import steroid
+from test_encoders import CaptureGame
+from steroid import Vector2D, lines_intersect
+
+numpy = steroid.numpy
+
+SPECIAL = [
+    ((0, 0), (10, 0)), ((5, 0), (15, 0)),        # colinear, overlapping
+    ((10, 0), (20, 0)),                          # colinear, touching at an end
+    ((0, 1), (10, 1)),                           # parallel
+    ((0, 0), (0, 0)), ((5, 0), (5, 0)),          # zero length
+    ((0, 0), (10, 0)),                           # identical
+    ((5, -5), (5, 5)), ((10, -5), (10, 0)),      # crossing, touching an end
+    ((0, 0), (10, 10)), ((10, 0), (0, 10)),
+    ((1e-9, 0), (10, 1e-9)), ((0, 0), (1e9, 1)),
+]
+
+
+def scalar(segment1, segment2):
+    (a, b), (c, d) = segment1, segment2
+    return lines_intersect(Vector2D(*a), Vector2D(*b), Vector2D(*c), Vector2D(*d))
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class SegmentsIntersectTest(unittest.TestCase):
+    # segments_intersect() agrees with lines_intersect()
+
+    def assertSameHits(self, segments1, segments2):
+        a = numpy.array([s[0] for s in segments1], dtype=float)
+        b = numpy.array([s[1] for s in segments1], dtype=float)
+        c = numpy.array([s[0] for s in segments2], dtype=float)
+        d = numpy.array([s[1] for s in segments2], dtype=float)
+        hits, points = steroid.segments_intersect(a[:, None], b[:, None], c[None], d[None], points=True)
+        self.assertEqual(hits.shape, (len(segments1), len(segments2)))
+
+        found = 0
+        for i, segment1 in enumerate(segments1):
+            for j, segment2 in enumerate(segments2):
+                point = scalar(segment1, segment2)
+                self.assertEqual(bool(hits[i, j]), point is not None, (segment1, segment2))
+                if point is None:
+                    self.assertTrue(numpy.isnan(points[i, j]).all())
+                else:
+                    found += 1
+                    self.assertEqual(tuple(points[i, j]), (point.x, point.y), (segment1, segment2))
+        return found
+
+    def test_random(self):
+        rnd = random.Random(3)
+        segments = [((rnd.uniform(0, 100), rnd.uniform(0, 100)), (rnd.uniform(0, 100), rnd.uniform(0, 100)))
+                    for _ in range(100)]
+        self.assertTrue(self.assertSameHits(segments, segments) > 0)
+
+    def test_grid(self):
+        # every segment of a 3x3 grid: shared ends, t and u exactly 0 or 1,
+        # parallel and colinear segments
+        segments = [((x1, y1), (x2, y2)) for x1, y1, x2, y2 in itertools.product(range(3), repeat=4)]
+        self.assertSameHits(segments, segments)
+
+    def test_special(self):
+        self.assertSameHits(SPECIAL, SPECIAL)
+
+    def test_parallel(self):
+        a, b = numpy.array([0.0, 0.0]), numpy.array([10.0, 0.0])
+        for c, d in (((0.0, 1.0), (10.0, 1.0)), ((5.0, 0.0), (15.0, 0.0)), ((10.0, 0.0), (20.0, 0.0)), ((0.0, 0.0), (10.0, 0.0))):
+            self.assertFalse(steroid.segments_intersect(a, b, numpy.array(c), numpy.array(d)))
+
+    def test_many_polygons(self):
+        # (N, 4, 2) vertices against a border
+        rnd = random.Random(4)
+        vertices = numpy.array([[(rnd.uniform(-50, 1050), rnd.uniform(0, 1000)) for _ in range(4)] for _ in range(200)])
+        ends = numpy.roll(vertices, -1, axis=1)
+        border = [numpy.array(point, dtype=float) for point in steroid.BORDER_LEFT]
+        crossing = steroid.segments_intersect(vertices, ends, *border).any(axis=1)
+
+        for polygon, hit in zip(vertices.tolist(), crossing):
+            expected = any(scalar(edge, steroid.BORDER_LEFT) for edge in steroid.poly_points_closed(polygon))
+            self.assertEqual(bool(hit), expected)
+        self.assertTrue(crossing.any())
+
+    def test_polygons_intersect(self):
+        rnd = random.Random(5)
+        polygons = [[(rnd.uniform(0, 200), rnd.uniform(0, 200)) for _ in range(rnd.choice((3, 4)))] for _ in range(60)]
+        for poly1, poly2 in itertools.product(polygons[:20], polygons + [steroid.BORDER_TOP, steroid.BORDER_LEFT]):
+            expected = any(scalar(edge1, edge2) for edge1 in steroid.poly_points_closed(poly1)
+                           for edge2 in steroid.poly_points_closed(poly2))
+            self.assertEqual(steroid.polygons_intersect(poly1, poly2), expected)
+
+
+class CollidingTest(unittest.TestCase):
+    # colliding() of the broad phase pairs agrees with is_colliding()
+
+    def setUp(self):
+        rnd = random.Random(5)
+        random.seed(5)
+        steroid.game_objects = []
+        for _ in range(15):
+            asteroid = steroid.Asteroid("A", rnd.randint(0, 1000), rnd.randint(0, 1000), rnd.random() * 6)
+            asteroid.width = rnd.randint(100, 300) // 3
+        for _ in range(200):
+            particle = steroid.Particle("P", False, rnd.randint(0, 1000), rnd.randint(0, 1000), rnd.random() * 6)
+            particle.width = rnd.randint(5, 60)
+        for _ in range(5):
+            steroid.Player("PL", rnd.randint(0, 1000), rnd.randint(0, 1000), rnd.random() * 6)
+        self.objects = list(steroid.game_objects)
+        steroid.draw_objects(self.objects)
+        # a polygon given as a list, not a view of the vertices
+        self.objects[3].polygon = [tuple(point) for point in self.objects[3].polygon]
+
+    def tearDown(self):
+        steroid.game_objects = None
+
+    def test_pairs(self):
+        pairs = steroid.SpatialGrid().pairs(self.objects)
+        hits = steroid.colliding(pairs)
+        self.assertEqual(hits, [go1.is_colliding(go2) for go1, go2 in pairs])
+        self.assertTrue(any(hits))
+        self.assertFalse(all(hits))
+
+    def test_draw_frame(self):
+        # draw_frame() holds back the primitives of draw_poly(), one per
+        # object, in groups of color and priority
+        game = CaptureGame()
+        game.setResolution(1000).setFrameBudget(EdgeLaser.FrameBudget())
+        vertices = steroid.draw_objects(self.objects)
+        self.objects[0].x = -10
+        steroid.draw_objects([self.objects[0]])
+        self.objects[1].destroy()
+        self.objects[2].clone().x += 1000
+
+        for game_obj in steroid.game_objects:
+            steroid.draw_poly(game, game_obj)
+        expected, game.pending = game.pending, []
+        steroid.draw_frame(game, self.objects, vertices)
+        self.assertEqual(sorted(game.pending), sorted(expected))
+        self.assertEqual(len(expected), len(steroid.game_objects))
+
+    def test_scalar(self):
+        # the Vector2D loop used without numpy gives the same answers
+        pairs = steroid.SpatialGrid().pairs(self.objects)
+        hits = steroid.colliding(pairs)
+        saved, steroid.numpy = steroid.numpy, None
+        try:
+            self.assertEqual([go1.is_colliding(go2) for go1, go2 in pairs], hits)
+        finally:
+            steroid.numpy = saved
+
+
+class NullGame(object):
+    def addPolygon(self, *args):
+        pass
+
+    def addLinesArray(self, *args, **kwargs):
+        pass
+
+
+@unittest.skipIf(numpy is None, "needs numpy")
+class WorldTest(unittest.TestCase):
+    # World.step() moves the objects like their apply_movement()
+
+    def tearDown(self):
+        steroid.use_world(False)
+        steroid.game_objects = None
+
+    def run_frames(self, use_world, frames=60):
+        # spinning asteroids wrapping across each border, with their clones
+        random.seed(6)
+        steroid.game_objects = []
+        steroid.use_world(use_world)
+        for x, y, heading in ((20, 300, math.pi), (steroid.SPACE_X - 20, 700, 0), (500, 20, -math.pi / 2),
+                              (300, steroid.SPACE_Y - 20, math.pi / 2)):
+            asteroid = steroid.Asteroid("A", x, y, 0.5)
+            asteroid.width = 60
+            asteroid.movement_vector.angle.value = heading
+            asteroid.movement_vector.value = 3
+            asteroid.moment = 0.03
+
+        trace = []
+        for _ in range(frames):
+            steroid.update_world(NullGame())
+            trace.append(sorted((round(obj.x, 6), round(obj.y, 6), round(obj.angle.value, 6), obj.is_clone())
+                                for obj in steroid.game_objects))
+        self.assertTrue(any(state[-1] for state in itertools.chain(*trace)))
+        return trace
+
+    def test_wrapping(self):
+        expected = self.run_frames(False)
+        self.assertEqual(self.run_frames(True), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()